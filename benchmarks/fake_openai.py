@@ -0,0 +1,305 @@
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from itertools import count
+
+from aiohttp import web
+
+ANSWER = (
+    "Семья и здоровье часто называют главными ценностями. "
+    "Судя по вашим словам, для вас особенно важна свобода выбора. "
+    "Расскажите, в каких ситуациях вы чувствуете её сильнее всего? "
+    "Это поможет понять, как она связана с другими вашими ценностями."
+)
+
+
+@dataclass
+class FakeOpenAIConfig:
+    latency: dict = field(default_factory=lambda: {
+        "transcription": 0.8,
+        "speech": 1.2,
+        "chat": 0.6,
+        "vision": 1.5,
+        "run": 2.0,
+        "threads": 0.05,
+    })
+    error_rate: float = 0.0
+    tool_call_rate: float = 0.5
+    stream_chunk_delay: float = 0.03
+    speech_bytes: int = 48_000
+
+
+class FakeOpenAI:
+    def __init__(self, config: FakeOpenAIConfig):
+        self.config = config
+        self.ids = count(1)
+        self.runs: dict[str, dict] = {}
+        self.messages: dict[str, list[dict]] = {}
+
+    def _id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self.ids)}"
+
+    async def _delay(self, kind: str):
+        mean = self.config.latency.get(kind, 0.0)
+        if mean:
+            await asyncio.sleep(random.expovariate(1 / mean))
+
+    def _maybe_fail(self) -> web.Response | None:
+        if random.random() < self.config.error_rate:
+            return web.json_response(
+                {"error": {"message": "injected failure", "type": "server_error"}},
+                status=random.choice([429, 500, 503]),
+                headers={"retry-after-ms": "200"},
+            )
+        return None
+
+    def _message(self, thread_id: str, role: str, text: str, run_id: str | None = None) -> dict:
+        return {
+            "id": self._id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "run_id": run_id,
+            "status": "completed",
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "attachments": [],
+            "metadata": {},
+        }
+
+    def _run(self, run: dict) -> dict:
+        data = {
+            "id": run["id"],
+            "object": "thread.run",
+            "created_at": int(run["created_at"]),
+            "thread_id": run["thread_id"],
+            "assistant_id": run["assistant_id"],
+            "status": run["status"],
+            "required_action": None,
+            "tools": [],
+            "metadata": {},
+        }
+        if run["status"] == "requires_action":
+            data["required_action"] = {
+                "type": "submit_tool_outputs",
+                "submit_tool_outputs": {"tool_calls": run["tool_calls"]},
+            }
+        return data
+
+    def _advance(self, run: dict):
+        if run["status"] == "in_progress" and time.monotonic() >= run["ready_at"]:
+            if run["tool_calls"] and not run["tools_done"]:
+                run["status"] = "requires_action"
+            else:
+                run["status"] = "completed"
+                self.messages[run["thread_id"]].append(
+                    self._message(run["thread_id"], "assistant", ANSWER, run["id"])
+                )
+
+    def _tool_calls(self) -> list[dict]:
+        if random.random() >= self.config.tool_call_rate:
+            return []
+        return [
+            {
+                "id": self._id("call"),
+                "type": "function",
+                "function": {"name": "validate_value", "arguments": json.dumps({"value": value})},
+            }
+            for value in random.sample(["семья", "свобода", "здоровье", "карьера", "дружба"], k=2)
+        ]
+
+    async def transcription(self, request: web.Request) -> web.StreamResponse:
+        await request.read()
+        await self._delay("transcription")
+        failure = self._maybe_fail()
+        if failure is not None:
+            return failure
+        return web.json_response({"text": "Для меня важны семья и свобода."})
+
+    async def speech(self, request: web.Request) -> web.StreamResponse:
+        await request.json()
+        await self._delay("speech")
+        failure = self._maybe_fail()
+        if failure is not None:
+            return failure
+        return web.Response(body=random.randbytes(self.config.speech_bytes), content_type="audio/ogg")
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        is_vision = any(isinstance(m.get("content"), list) for m in body.get("messages", []))
+        await self._delay("vision" if is_vision else "chat")
+        failure = self._maybe_fail()
+        if failure is not None:
+            return failure
+        if "response_format" in body:
+            content = json.dumps({"is_valid": True, "value_type": body["messages"][-1]["content"].split()[-1]})
+        elif is_vision:
+            content = random.choice(["счастье", "грусть", "нейтрально"])
+        else:
+            content = ANSWER
+        return web.json_response({
+            "id": self._id("chatcmpl"),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 120, "completion_tokens": 40, "total_tokens": 160},
+        }, headers={"x-ratelimit-remaining-requests": "1000", "x-ratelimit-reset-requests": "1s"})
+
+    async def create_thread(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json() if request.can_read_body else {}
+        await self._delay("threads")
+        thread_id = self._id("thread")
+        self.messages[thread_id] = [
+            self._message(thread_id, m.get("role", "user"), m.get("content", "")) for m in body.get("messages", [])
+        ]
+        return web.json_response({"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {}})
+
+    async def create_message(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await self._delay("threads")
+        thread_id = request.match_info["thread_id"]
+        message = self._message(thread_id, body["role"], body["content"])
+        self.messages.setdefault(thread_id, []).append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request: web.Request) -> web.StreamResponse:
+        await self._delay("threads")
+        thread_id = request.match_info["thread_id"]
+        messages = list(self.messages.get(thread_id, []))
+        if request.query.get("order", "desc") == "desc":
+            messages.reverse()
+        if run_id := request.query.get("run_id"):
+            messages = [m for m in messages if m["run_id"] == run_id]
+        messages = messages[:int(request.query.get("limit", 20))]
+        return web.json_response({
+            "object": "list",
+            "data": messages,
+            "first_id": messages[0]["id"] if messages else None,
+            "last_id": messages[-1]["id"] if messages else None,
+            "has_more": False,
+        })
+
+    async def create_run(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await self._delay("threads")
+        thread_id = request.match_info["thread_id"]
+        run = {
+            "id": self._id("run"),
+            "thread_id": thread_id,
+            "assistant_id": body.get("assistant_id"),
+            "created_at": time.time(),
+            "status": "in_progress",
+            "ready_at": time.monotonic() + random.expovariate(1 / self.config.latency["run"]),
+            "tool_calls": self._tool_calls(),
+            "tools_done": False,
+        }
+        self.runs[run["id"]] = run
+        self.messages.setdefault(thread_id, [])
+        if body.get("stream"):
+            return await self._stream_run(request, run)
+        return web.json_response(self._run(run))
+
+    async def retrieve_run(self, request: web.Request) -> web.StreamResponse:
+        await self._delay("threads")
+        run = self.runs[request.match_info["run_id"]]
+        self._advance(run)
+        return web.json_response(self._run(run))
+
+    async def cancel_run(self, request: web.Request) -> web.StreamResponse:
+        await self._delay("threads")
+        run = self.runs[request.match_info["run_id"]]
+        self._advance(run)
+        if run["status"] in ("completed", "failed", "cancelled", "expired"):
+            return web.json_response(
+                {"error": {"message": f"Cannot cancel run with status '{run['status']}'.", "type": "invalid_request_error"}},
+                status=400,
+            )
+        run["status"] = "cancelled"
+        return web.json_response(self._run(run))
+
+    async def submit_tool_outputs(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await self._delay("threads")
+        run = self.runs[request.match_info["run_id"]]
+        run["tools_done"] = True
+        run["status"] = "in_progress"
+        run["ready_at"] = time.monotonic() + random.expovariate(2 / self.config.latency["run"])
+        if body.get("stream"):
+            return await self._stream_run(request, run)
+        return web.json_response(self._run(run))
+
+    async def _stream_run(self, request: web.Request, run: dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(event: str, data):
+            payload = data if isinstance(data, str) else json.dumps(data)
+            await response.write(f"event: {event}\ndata: {payload}\n\n".encode())
+
+        await send("thread.run.in_progress", self._run(run))
+        await asyncio.sleep(max(0.0, run["ready_at"] - time.monotonic()) / 2)
+        if run["tool_calls"] and not run["tools_done"]:
+            run["status"] = "requires_action"
+            await send("thread.run.requires_action", self._run(run))
+        else:
+            message_id = self._id("msg")
+            for word in ANSWER.split(" "):
+                await asyncio.sleep(self.config.stream_chunk_delay)
+                await send("thread.message.delta", {
+                    "id": message_id,
+                    "object": "thread.message.delta",
+                    "delta": {"content": [{"index": 0, "type": "text", "text": {"value": word + " "}}]},
+                })
+            run["status"] = "completed"
+            await send("thread.run.completed", self._run(run))
+        await send("done", "[DONE]")
+        await response.write_eof()
+        return response
+
+    async def retrieve_file(self, request: web.Request) -> web.StreamResponse:
+        await self._delay("threads")
+        return web.json_response({
+            "id": request.match_info["file_id"],
+            "object": "file",
+            "bytes": 1024,
+            "created_at": int(time.time()),
+            "filename": "values.pdf",
+            "purpose": "assistants",
+            "status": "processed",
+        })
+
+    async def retrieve_assistant(self, request: web.Request) -> web.StreamResponse:
+        return web.json_response({
+            "id": request.match_info["assistant_id"],
+            "object": "assistant",
+            "created_at": int(time.time()),
+            "model": "gpt-4o",
+            "tools": [{"type": "file_search"}],
+            "tool_resources": {"file_search": {"vector_store_ids": ["vs_bench"]}},
+            "metadata": {},
+        })
+
+    async def list_vector_store_files(self, request: web.Request) -> web.StreamResponse:
+        data = [{"id": "file_bench", "object": "vector_store.file", "status": "completed"}]
+        return web.json_response({"object": "list", "data": data, "first_id": "file_bench",
+                                  "last_id": "file_bench", "has_more": False})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/audio/transcriptions", self.transcription)
+        app.router.add_post("/v1/audio/speech", self.speech)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/threads", self.create_thread)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self.create_message)
+        app.router.add_get("/v1/threads/{thread_id}/messages", self.list_messages)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self.create_run)
+        app.router.add_get("/v1/threads/{thread_id}/runs/{run_id}", self.retrieve_run)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/submit_tool_outputs", self.submit_tool_outputs)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run)
+        app.router.add_get("/v1/files/{file_id}", self.retrieve_file)
+        app.router.add_get("/v1/assistants/{assistant_id}", self.retrieve_assistant)
+        app.router.add_get("/v1/vector_stores/{vector_store_id}/files", self.list_vector_store_files)
+        return app
@@ -0,0 +1,80 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from itertools import count
+
+from aiohttp import web
+
+
+@dataclass
+class FakeTelegramConfig:
+    latency: float = 0.05
+    download_latency: float = 0.1
+    voice_bytes: int = 32_000
+    photo_side: int = 1280
+
+
+def make_jpeg(side: int) -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return random.randbytes(side * side // 8)
+    image = Image.effect_noise((side, side), 64).convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class FakeTelegram:
+    def __init__(self, config: FakeTelegramConfig):
+        self.config = config
+        self.message_ids = count(1)
+        self.voice = random.randbytes(config.voice_bytes)
+        self.photo = make_jpeg(config.photo_side)
+        self.sent = {"sendMessage": 0, "sendVoice": 0, "sendChatAction": 0, "editMessageMedia": 0}
+
+    async def _delay(self, mean: float):
+        if mean:
+            await asyncio.sleep(random.expovariate(1 / mean))
+
+    def _message(self, chat_id) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+        }
+
+    async def method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post()) if request.can_read_body else {}
+        await self._delay(self.config.latency)
+        if method in self.sent:
+            self.sent[method] += 1
+
+        if method == "getFile":
+            file_id = data["file_id"]
+            path = f"photos/{file_id}.jpg" if file_id.startswith("photo") else f"voice/{file_id}.oga"
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": path}
+        elif method in ("sendMessage", "sendVoice", "editMessageMedia"):
+            result = self._message(data.get("chat_id", 0))
+            if method != "sendMessage":
+                result["voice"] = {"file_id": f"sent{result['message_id']}", "file_unique_id": f"sent{result['message_id']}",
+                                   "duration": 3}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def download(self, request: web.Request) -> web.Response:
+        await self._delay(self.config.download_latency)
+        body = self.photo if request.match_info["path"].startswith("photos/") else self.voice
+        return web.Response(body=body, content_type="application/octet-stream")
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.download)
+        return app
@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import time
+import tracemalloc
+from dataclasses import asdict
+
+from benchmarks.fake_openai import FakeOpenAI, FakeOpenAIConfig
+from benchmarks.fake_telegram import FakeTelegram, FakeTelegramConfig
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(kind: str, port: int, config):
+    from aiohttp import web
+    fake = FakeOpenAI(config) if kind == "openai" else FakeTelegram(config)
+    web.run_app(fake.app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Fake server on port {port} did not start")
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def histogram_quantile(buckets: list[tuple[float, float]], q: float) -> float:
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return 0.0
+    rank = q * total
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            share = (rank - previous_count) / (cumulative - previous_count) if cumulative > previous_count else 0
+            return previous_bound + (bound - previous_bound) * share
+        previous_bound, previous_count = bound, cumulative
+    return previous_bound
+
+
+def stage_latencies() -> dict:
+    from prometheus_client import REGISTRY
+    stages: dict[str, list[tuple[float, float]]] = {}
+    errors: dict[str, float] = {}
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            if sample.name == "bot_stage_latency_seconds_bucket":
+                stages.setdefault(sample.labels["stage"], []).append((float(sample.labels["le"]), sample.value))
+            elif sample.name == "bot_stage_errors_total":
+                errors[sample.labels["stage"]] = sample.value
+    return {
+        stage: {
+            "count": int(buckets[-1][1]),
+            "p50": histogram_quantile(buckets, 0.50),
+            "p95": histogram_quantile(buckets, 0.95),
+            "p99": histogram_quantile(buckets, 0.99),
+            "errors": int(errors.get(stage, 0)),
+        }
+        for stage, buckets in sorted(stages.items())
+        if buckets[-1][1]
+    }
+
+
+def user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+
+
+def make_update(kind: str, update_id: int, user_id: int, media_id: int) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user(user_id),
+    }
+    if kind == "voice":
+        message["voice"] = {"file_id": f"voice{media_id}", "file_unique_id": f"voice{media_id}", "duration": 6}
+    elif kind == "image":
+        message["photo"] = [
+            {"file_id": f"photo{media_id}_{side}", "file_unique_id": f"photo{media_id}_{side}",
+             "width": side, "height": side * 3 // 4}
+            for side in (90, 320, 800, 1280)
+        ]
+    else:
+        message["text"] = "/my_values"
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len("/my_values")}]
+    return {"update_id": update_id, "message": message}
+
+
+def configure_environment(args, telegram_port: int, openai_port: int):
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "OPENAI_ASSISTANT_ID": "asst_bench",
+        "OPENAI_AMPLITUDE_KEY": "",
+        "REDIS_HOST": args.redis_host,
+        "REDIS_PORT": str(args.redis_port),
+        "REDIS_PASSWORD": args.redis_password,
+        "REDIS_DB": str(args.redis_db),
+        "MYSQL_HOST": "localhost",
+        "MYSQL_PORT": "3306",
+        "MYSQL_DATABASE": "bench",
+        "MYSQL_USER": "bench",
+        "MYSQL_PASSWORD": "bench",
+        "DATABASE_URL": args.database_url,
+        "DATABASE_ECHO": "false",
+        "STREAMING_REPLIES": str(args.stream).lower(),
+        "PROGRESSIVE_REPLIES": str(args.progressive).lower(),
+        # Every fake answer is identical, so the TTS cache would hide synthesis latency
+        "TTS_CACHE_DIR": args.tts_cache_dir,
+        "TTS_CACHE_MAX_BYTES": str(256 * 1024 * 1024 if args.tts_cache else 0),
+        "TTS_PREWARM": str(args.tts_cache).lower(),
+    })
+
+
+async def drive(args) -> dict:
+    from aiogram.types import Update
+    from src.app import create_app
+    from src.bot import create_dispatcher
+    from src.utils.logger import setup_logging
+
+    setup_logging()
+    app = create_app()
+    dp = create_dispatcher(app)
+    bot = app.bot
+
+    weights = {kind: int(weight) for kind, weight in (part.split("=") for part in args.mix.split(","))}
+    kinds = random.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    latencies: dict[str, list[float]] = {kind: [] for kind in weights}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(update_id: int, kind: str):
+        user_id = random.randint(1, args.users)
+        media_id = random.randint(1, args.distinct_media) if args.distinct_media else update_id
+        update = Update.model_validate(make_update(kind, update_id, user_id, media_id), context={"bot": bot})
+        async with semaphore:
+            started = time.perf_counter()
+            await dp.feed_update(bot, update)
+            latencies[kind].append(time.perf_counter() - started)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, **dp.workflow_data)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(update_id, kind) for update_id, kind in enumerate(kinds, start=1)))
+    elapsed = time.perf_counter() - started
+    await dp.emit_shutdown(bot=bot, dispatcher=dp, **dp.workflow_data)
+    await bot.session.close()
+
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed": elapsed,
+        "throughput": args.requests / elapsed if elapsed else 0.0,
+        "end_to_end": {
+            kind: {
+                "count": len(samples),
+                "p50": percentile(samples, 0.50),
+                "p95": percentile(samples, 0.95),
+                "p99": percentile(samples, 0.99),
+            }
+            for kind, samples in latencies.items()
+        },
+        "stages": stage_latencies(),
+    }
+
+
+def print_report(report: dict):
+    print(f"\n{report['requests']} updates at concurrency {report['concurrency']} "
+          f"in {report['elapsed']:.2f}s ({report['throughput']:.1f} updates/s)")
+    print(f"\n{'scenario':<20}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for kind, row in report["end_to_end"].items():
+        print(f"{kind:<20}{row['count']:>8}{row['p50']:>10.3f}{row['p95']:>10.3f}{row['p99']:>10.3f}")
+    print(f"\n{'stage':<20}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'errors':>8}")
+    for stage, row in report["stages"].items():
+        print(f"{stage:<20}{row['count']:>8}{row['p50']:>10.3f}{row['p95']:>10.3f}{row['p99']:>10.3f}"
+              f"{row['errors']:>8}")
+    memory = report["memory"]
+    print(f"\nmax RSS: {memory['max_rss_mb']:.1f} MB", end="")
+    if memory.get("traced_peak_mb") is not None:
+        print(f", traced Python peak: {memory['traced_peak_mb']:.1f} MB", end="")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline load test: drives the bot handlers against local fake Telegram and OpenAI servers"
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--mix", default="voice=6,image=3,values=1")
+    parser.add_argument("--distinct-media", type=int, default=0,
+                        help="Reuse this many media ids to exercise the caches (0 = every update is unique)")
+    parser.add_argument("--stream", action="store_true", help="Enable STREAMING_REPLIES")
+    parser.add_argument("--progressive", action="store_true", help="Enable PROGRESSIVE_REPLIES")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tool-call-rate", type=float, default=0.5)
+    parser.add_argument("--tts-cache", action="store_true", help="Keep the synthesized-audio cache enabled")
+    parser.add_argument("--tts-cache-dir", default="bench_tts_cache")
+    parser.add_argument("--database-url", default="sqlite+aiosqlite:///bench.db")
+    parser.add_argument("--redis-host", default="", help="Empty keeps caches and FSM in memory")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-password", default="")
+    parser.add_argument("--redis-db", type=int, default=15)
+    parser.add_argument("--tracemalloc", action="store_true")
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    openai_config = FakeOpenAIConfig(error_rate=args.error_rate, tool_call_rate=args.tool_call_rate)
+    openai_config.latency = {kind: value * args.latency_scale for kind, value in openai_config.latency.items()}
+    telegram_config = FakeTelegramConfig(
+        latency=0.05 * args.latency_scale,
+        download_latency=0.1 * args.latency_scale,
+    )
+
+    telegram_port, openai_port = free_port(), free_port()
+    servers = [
+        multiprocessing.Process(target=serve, args=("telegram", telegram_port, telegram_config), daemon=True),
+        multiprocessing.Process(target=serve, args=("openai", openai_port, openai_config), daemon=True),
+    ]
+    for server in servers:
+        server.start()
+    try:
+        wait_for_port(telegram_port)
+        wait_for_port(openai_port)
+        configure_environment(args, telegram_port, openai_port)
+        if args.tracemalloc:
+            tracemalloc.start()
+        report = asyncio.run(drive(args))
+        report["memory"] = {
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "traced_peak_mb": tracemalloc.get_traced_memory()[1] / 1024 / 1024 if args.tracemalloc else None,
+        }
+        report["fake_openai"] = asdict(openai_config)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""value dictionary and user value counts
+
+Revision ID: 8f3a2c41d7e9
+Revises: 33b1138314c4
+Create Date: 2026-10-16 23:40:12.118204
+
+"""
+from collections import Counter
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f3a2c41d7e9'
+down_revision: Union[str, None] = '33b1138314c4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ID = sa.BigInteger().with_variant(sa.Integer(), "sqlite")
+# Keys are normalised below, a binary collation compares them exactly on MySQL too
+VALUE_TEXT = sa.String(length=255).with_variant(
+    mysql.VARCHAR(255, charset="utf8mb4", collation="utf8mb4_bin"), "mysql", "mariadb"
+)
+
+
+
+def value_key(value: str) -> str:
+    # Frozen copy of src.database.services.value_key as of this revision
+    return " ".join(value.casefold().replace("ё", "е").split())[:255].rstrip()
+
+
+def upgrade() -> None:
+    op.create_table('value_dictionary',
+    sa.Column('id', ID, autoincrement=True, nullable=False),
+    sa.Column('value', VALUE_TEXT, nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('value')
+    )
+    op.create_table('user_values_counted',
+    sa.Column('user_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('value_id', ID, nullable=False),
+    sa.Column('count', sa.Integer(), server_default='1', nullable=False),
+    sa.Column('last_seen', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+    sa.ForeignKeyConstraint(['value_id'], ['value_dictionary.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'value_id')
+    )
+
+    # One row per (user, value) with the number of times it was saved. Done in Python because
+    # SQLite's LOWER() only folds ASCII, so the keys would not match the ones the bot writes
+    bind = op.get_bind()
+    counts = Counter()
+    for user_id, value in bind.execute(sa.text("SELECT user_id, value FROM user_values")):
+        key = value_key(value or "")
+        if key:
+            counts[(user_id, key)] += 1
+    dictionary = sa.table('value_dictionary', sa.column('id', ID), sa.column('value', VALUE_TEXT))
+    counted = sa.table(
+        'user_values_counted',
+        sa.column('user_id', sa.BigInteger()),
+        sa.column('value_id', ID),
+        sa.column('count', sa.Integer()),
+    )
+    keys = sorted({key for _, key in counts})
+    if keys:
+        op.bulk_insert(dictionary, [{"value": key} for key in keys])
+        ids = dict(bind.execute(sa.select(dictionary.c.value, dictionary.c.id)).all())
+        op.bulk_insert(counted, [
+            {"user_id": user_id, "value_id": ids[key], "count": count}
+            for (user_id, key), count in counts.items()
+        ])
+
+    op.drop_index(op.f('ix_user_values_user_id'), table_name='user_values')
+    op.drop_index(op.f('ix_user_values_id'), table_name='user_values')
+    op.drop_table('user_values')
+    op.rename_table('user_values_counted', 'user_values')
+    op.create_index('ix_user_values_user_count', 'user_values', ['user_id', 'count', 'value_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_values_user_count', table_name='user_values')
+    op.rename_table('user_values', 'user_values_counted')
+    op.create_table('user_values',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('value', sa.String(length=255), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_user_values_id'), 'user_values', ['id'], unique=False)
+    op.create_index(op.f('ix_user_values_user_id'), 'user_values', ['user_id'], unique=False)
+    # Counts cannot be expanded back into individual rows, each pair is kept once
+    op.execute(
+        "INSERT INTO user_values (user_id, value) "
+        "SELECT c.user_id, d.value FROM user_values_counted c JOIN value_dictionary d ON d.id = c.value_id"
+    )
+    op.drop_table('user_values_counted')
+    op.drop_table('value_dictionary')
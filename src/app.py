@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import os
+import time
+from functools import cached_property
+
+from src.config import Settings, get_settings
+from src.utils.logger import STARTUP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def process_uptime() -> float | None:
+    # Counts interpreter start and imports too, which take longer than everything after them
+    try:
+        with open("/proc/self/stat") as stat, open("/proc/uptime") as uptime:
+            # starttime is the 22nd field, counted after the parenthesised command name
+            started = int(stat.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+            return float(uptime.read().split()[0]) - started
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class App:
+    # Resources are built on first use, so importing and creating the app never touches the network
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.created_at = time.perf_counter()
+        self.ready = False
+        self.started = False
+        self.in_flight: set[asyncio.Task] = set()
+        self.background_tasks: set[asyncio.Task] = set()
+
+    @cached_property
+    def redis(self):
+        if not self.settings.REDIS_HOST:
+            return None
+        from redis.asyncio import Redis
+        return Redis(
+            host=self.settings.REDIS_HOST,
+            port=self.settings.REDIS_PORT,
+            password=self.settings.REDIS_PASSWORD,
+            db=self.settings.REDIS_DB,
+        )
+
+    @cached_property
+    def storage(self):
+        if self.redis is None:
+            from aiogram.fsm.storage.memory import MemoryStorage
+            return MemoryStorage()
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage(redis=self.redis)
+
+    @cached_property
+    def bot(self):
+        from aiogram import Bot
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        session = None
+        if self.settings.TELEGRAM_API_URL:
+            session = AiohttpSession(api=TelegramAPIServer.from_base(self.settings.TELEGRAM_API_URL))
+        return Bot(token=self.settings.TELEGRAM_BOT_TOKEN, session=session, timeout=60.0)
+
+    @cached_property
+    def analytics(self):
+        from src.services.analytics import AnalyticsClient
+        return AnalyticsClient(
+            api_key=self.settings.OPENAI_AMPLITUDE_KEY,
+            queue_size=self.settings.ANALYTICS_QUEUE_SIZE,
+            batch_size=self.settings.ANALYTICS_BATCH_SIZE,
+            flush_interval=self.settings.ANALYTICS_FLUSH_INTERVAL,
+            max_property_length=self.settings.ANALYTICS_MAX_PROPERTY_LENGTH,
+        )
+
+    @cached_property
+    def scheduler(self):
+        from src.services.scheduler import Scheduler
+        return Scheduler(
+            limits={
+                "stt": self.settings.STT_CONCURRENCY,
+                "assistant": self.settings.ASSISTANT_CONCURRENCY,
+                "tts": self.settings.TTS_CONCURRENCY,
+                "vision": self.settings.VISION_CONCURRENCY,
+                "chat": self.settings.CHAT_CONCURRENCY,
+            },
+            redis=self.redis,
+            user_lock_timeout=self.settings.USER_LOCK_TIMEOUT,
+        )
+
+    @cached_property
+    def rate_limiter(self):
+        from src.services.openai_client import RateLimiter
+        return RateLimiter(
+            requests_per_minute={
+                "stt": self.settings.STT_RPM,
+                "tts": self.settings.TTS_RPM,
+                "chat": self.settings.CHAT_RPM,
+                "vision": self.settings.VISION_RPM,
+                "threads": self.settings.THREADS_RPM,
+                "files": self.settings.FILES_RPM,
+            },
+            redis=self.redis,
+        )
+
+    @cached_property
+    def thread_registry(self):
+        from src.services.thread_registry import ThreadRegistry
+        return ThreadRegistry(
+            self.redis,
+            max_size=self.settings.THREAD_REGISTRY_SIZE,
+            idle_ttl=self.settings.THREAD_IDLE_TTL,
+        )
+
+    @cached_property
+    def openai_service(self):
+        from src.services.cache import DiskCache
+        from src.services.openai_service import OpenAIBot
+        settings = self.settings
+        return OpenAIBot(
+            api_key=settings.OPENAI_API_KEY,
+            assistant_id=settings.OPENAI_ASSISTANT_ID,
+            analytics=self.analytics,
+            tool_concurrency=settings.TOOL_CALL_CONCURRENCY,
+            redis=self.redis,
+            validation_cache_size=settings.VALIDATION_CACHE_SIZE,
+            validation_cache_ttl=settings.VALIDATION_CACHE_TTL,
+            vision_detail=settings.VISION_DETAIL,
+            scheduler=self.scheduler,
+            rate_limiter=self.rate_limiter,
+            request_deadline=settings.OPENAI_REQUEST_DEADLINE,
+            hedge_delay=settings.OPENAI_HEDGE_DELAY,
+            run_poll_interval=settings.OPENAI_RUN_POLL_INTERVAL,
+            run_timeout=settings.OPENAI_RUN_TIMEOUT,
+            threads=self.thread_registry,
+            base_url=settings.OPENAI_BASE_URL or None,
+            compact_after_turns=settings.THREAD_COMPACT_AFTER_TURNS,
+            compact_history_messages=settings.THREAD_COMPACT_HISTORY_MESSAGES,
+            compaction_model=settings.THREAD_COMPACTION_MODEL,
+            run_truncation_messages=settings.RUN_TRUNCATION_MESSAGES,
+            tts_model=settings.TTS_MODEL,
+            tts_voice=settings.TTS_VOICE,
+            tts_format=settings.TTS_FORMAT,
+            audio_cache=DiskCache(settings.TTS_CACHE_DIR, "tts_audio", max_bytes=settings.TTS_CACHE_MAX_BYTES),
+        )
+
+    @cached_property
+    def mood_cache(self):
+        from src.services.cache import TwoTierCache
+        return TwoTierCache(
+            self.redis,
+            "photo_mood",
+            max_size=self.settings.PHOTO_MOOD_CACHE_SIZE,
+            ttl=self.settings.PHOTO_MOOD_CACHE_TTL,
+        )
+
+    @cached_property
+    def user_values_cache(self):
+        from src.services.cache import TwoTierCache
+        return TwoTierCache(
+            self.redis,
+            "user_values",
+            ttl=self.settings.USER_VALUES_CACHE_TTL,
+            local_ttl=self.settings.USER_VALUES_LOCAL_TTL,
+        )
+
+    @cached_property
+    def idempotency(self):
+        from src.services.idempotency import Idempotency
+        return Idempotency(
+            self.redis,
+            update_ttl=self.settings.IDEMPOTENCY_UPDATE_TTL,
+            result_ttl=self.settings.IDEMPOTENCY_RESULT_TTL,
+            pending_ttl=self.settings.IDEMPOTENCY_PENDING_TTL,
+        )
+
+    @cached_property
+    def job_queue(self):
+        if not self.settings.JOB_QUEUE_ENABLED or self.redis is None:
+            return None
+        from src.services.job_queue import JobQueue
+        return JobQueue(
+            self.redis,
+            shards=self.settings.JOB_SHARDS,
+            visibility_timeout=self.settings.JOB_VISIBILITY_TIMEOUT,
+            max_attempts=self.settings.JOB_MAX_ATTEMPTS,
+            maxlen=self.settings.JOB_STREAM_MAXLEN,
+            lease_ttl=self.settings.JOB_LEASE_TTL,
+        )
+
+    def run_in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    async def invalidate_user_values(self, user_ids: set[int]):
+        for user_id in user_ids:
+            await self.user_values_cache.invalidate(str(user_id))
+
+    async def start(self):
+        if self.started:
+            return
+        from src.database.database import init_db
+        from src.database.services import value_writer
+        from src.services.openai_service import FALLBACK_ANSWERS
+
+        started = time.perf_counter()
+        self.started = True
+        if self.settings.DATABASE_CREATE_TABLES:
+            await init_db()
+        value_writer.configure(
+            batch_size=self.settings.VALUE_FLUSH_BATCH_SIZE,
+            flush_interval=self.settings.VALUE_FLUSH_INTERVAL,
+        )
+        value_writer.on_flush.append(self.invalidate_user_values)
+        await value_writer.start()
+        await self.analytics.start()
+        # Warm-ups call OpenAI and may take seconds, so they must not hold up readiness
+        self.run_in_background(self.openai_service.warm_file_cache())
+        if self.settings.TTS_PREWARM:
+            self.run_in_background(
+                self.openai_service.prewarm_audio_cache([*FALLBACK_ANSWERS, *self.settings.TTS_PREWARM_TEXTS])
+            )
+        self.ready = True
+
+        now = time.perf_counter()
+        uptime = process_uptime()
+        total = uptime if uptime is not None else now - self.created_at
+        STARTUP_SECONDS.set(total)
+        logger.info(
+            f"Started in {total:.3f}s since process start "
+            f"({total - (now - self.created_at):.3f}s before the app was created, {now - started:.3f}s in start hooks)"
+        )
+        if total > self.settings.STARTUP_BUDGET:
+            logger.warning(f"Startup took {total:.3f}s, over the {self.settings.STARTUP_BUDGET}s budget")
+
+    async def stop(self):
+        if not self.started:
+            return
+        from src.database.database import dispose_engine
+        from src.database.services import value_writer
+
+        self.ready = False
+        if self.in_flight:
+            logger.info(f"Waiting for {len(self.in_flight)} in-flight updates to finish")
+            _, pending = await asyncio.wait(set(self.in_flight), timeout=self.settings.SHUTDOWN_TIMEOUT)
+            if pending:
+                logger.warning(f"{len(pending)} updates did not finish before shutdown")
+        for task in self.background_tasks:
+            task.cancel()
+        await value_writer.stop()
+        if self.invalidate_user_values in value_writer.on_flush:
+            value_writer.on_flush.remove(self.invalidate_user_values)
+        await self.analytics.stop()
+        await dispose_engine()
+        if "redis" in self.__dict__ and self.redis is not None:
+            await self.redis.aclose()
+        self.started = False
+
+    async def check_ready(self) -> dict:
+        checks = {"started": self.ready}
+        if self.ready and self.redis is not None:
+            try:
+                checks["redis"] = bool(await asyncio.wait_for(self.redis.ping(), timeout=1.0))
+            except Exception as e:
+                logger.warning(f"Readiness check failed for Redis: {e}")
+                checks["redis"] = False
+        return checks
+
+
+def create_app(settings: Settings | None = None) -> App:
+    return App(settings or get_settings())
@@ -1,55 +1,128 @@
-import aiofiles
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage import redis
-from aiogram.fsm.storage.redis import RedisStorage
-from aiogram.types import FSInputFile
-from aiogram import Bot, Dispatcher
-from aiogram.types import Message
-from aiogram.filters import Command
-from src.config import settings
-from src.database.database import init_db
+from aiohttp import web
+from aiogram.types import BufferedInputFile
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message, ReplyParameters
+from aiogram.filters import Command, CommandObject
+from aiogram.utils.chat_action import ChatActionSender
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from src.app import App, create_app
 from src.database.services import get_user_values, save_value
-from src.services.openai_service import OpenAIBot
+from src.services.job_queue import Job
+from src.utils.logger import metrics_handler, setup_logging, track_stage
+from src.utils.audio import split_voice
+from src.utils.images import MOOD_UNDETECTED, dhash, downscale_jpeg, pick_photo_size
+from contextlib import nullcontext
+from functools import partial
 import asyncio
 import logging
-import os
 import base64
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-redis_connection = redis.Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    password=settings.REDIS_PASSWORD,
-    db=settings.REDIS_DB
-)
-storage = RedisStorage(redis=redis_connection)
-openai_service = OpenAIBot(api_key=settings.OPENAI_API_KEY, assistant_id=settings.OPENAI_ASSISTANT_ID,amplitude_key=settings.OPENAI_AMPLITUDE_KEY)
+router = Router()
+APP_KEY = web.AppKey("app", App)
 
-bot = Bot(token=settings.TELEGRAM_BOT_TOKEN, timeout=60.0)
-dp = Dispatcher()
 
+async def skip_redelivered_updates(handler, event, data):
+    if not await data["bot_app"].idempotency.first_delivery(event.update_id):
+        logger.info(f"Skipping redelivered update {event.update_id}")
+        return None
+    return await handler(event, data)
 
-async def download_file(file_id: str, file_name: str) -> str:
+
+async def track_in_flight(handler, event, data):
+    in_flight = data["bot_app"].in_flight
+    task = asyncio.current_task()
+    in_flight.add(task)
     try:
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        downloaded_file = await bot.download_file(file_path)
+        return await handler(event, data)
+    finally:
+        in_flight.discard(task)
 
-        async with aiofiles.open(file_name, "wb") as f:
-            await f.write(downloaded_file.read())
 
-        logger.info(f"{file_name} successfully downloaded.")
-        return file_name
+@track_stage("download_file")
+async def download_file(app: App, file_id: str) -> bytes:
+    try:
+        file = await app.bot.get_file(file_id)
+        downloaded_file = await app.bot.download_file(file.file_path)
+        content = downloaded_file.getvalue()
+        logger.info(f"File {file_id} successfully downloaded ({len(content)} bytes).")
+        return content
     except Exception as e:
         logger.error(f"Error in downloading file: {e}")
         raise
 
-async def image_to_base64(file_path: str) -> str:
+async def load_user_values(app: App, user_id: int) -> list[tuple[str, int]]:
+    values = await app.user_values_cache.get(str(user_id))
+    if values is None:
+        # Taken before reading, so a flush that lands during the query keeps the old list out of the cache
+        generation = await app.user_values_cache.generation(str(user_id))
+        values = await get_user_values(user_id, limit=app.settings.USER_VALUES_LIMIT)
+        if values is None:
+            return []
+        await app.user_values_cache.set(str(user_id), values, generation=generation)
+    return [(value, count) for value, count in values]
+
+
+async def transcribe_voice(app: App, content: bytes) -> str:
+    settings = app.settings
+    openai_service = app.openai_service
+    chunks = [content]
+    if settings.AUDIO_PREPROCESSING:
+        async with track_stage("audio_preprocess"):
+            chunks = await split_voice(
+                content,
+                max_chunk=settings.STT_CHUNK_SECONDS,
+                sample_rate=settings.AUDIO_SAMPLE_RATE,
+                bitrate=settings.AUDIO_BITRATE,
+                silence_threshold=settings.AUDIO_SILENCE_THRESHOLD,
+                min_silence=settings.AUDIO_MIN_SILENCE,
+            )
+    if len(chunks) == 1:
+        return await openai_service.voice_to_text(chunks[0])
+    texts = await asyncio.gather(*(openai_service.voice_to_text(chunk) for chunk in chunks))
+    return " ".join(text.strip() for text in texts if text and text.strip())
+
+
+def image_to_base64(content: bytes) -> str:
     logger.info(f"Converting image to base64...")
-    async with aiofiles.open(file_path, "rb") as f:
-        file_content = await f.read()
-        return base64.b64encode(file_content).decode("utf-8")
-@dp.message(Command("start"))
+    return base64.b64encode(content).decode("utf-8")
+
+
+@track_stage("photo_mood")
+async def get_photo_mood(app: App, file_id: str, file_unique_id: str, user_id: int) -> str:
+    settings = app.settings
+    mood_cache = app.mood_cache
+    file_key = f"file:{file_unique_id}"
+    mood = await mood_cache.get(file_key)
+    if mood is not None:
+        logger.info(f"Photo mood cache hit for {file_unique_id}")
+        return mood
+
+    image = await download_file(app, file_id)
+    try:
+        hash_key = f"dhash:{await asyncio.to_thread(dhash, image)}"
+    except Exception as e:
+        logger.warning(f"Could not hash photo {file_unique_id}: {e}")
+        hash_key = None
+
+    mood = await mood_cache.get(hash_key) if hash_key else None
+    if mood is None:
+        try:
+            image = await asyncio.to_thread(
+                downscale_jpeg, image, settings.VISION_TARGET_SIDE, settings.VISION_JPEG_QUALITY
+            )
+        except Exception as e:
+            logger.warning(f"Could not downscale photo {file_unique_id}: {e}")
+        mood = await app.openai_service.analyze_mood_from_photo(image_to_base64(image), user_id)
+        if mood == MOOD_UNDETECTED:
+            return mood
+        if hash_key:
+            await mood_cache.set(hash_key, mood)
+    else:
+        logger.info(f"Photo mood cache hit for perceptual hash {hash_key}")
+
+    await mood_cache.set(file_key, mood)
+    return mood
+@router.message(Command("start"))
 async def start(message: Message):
     try:
         await message.answer(
@@ -62,7 +135,7 @@ async def start(message: Message):
         logger.error(f"Error in start command: {e}")
 
 
-@dp.message(Command("help"))
+@router.message(Command("help"))
 async def help_command(message: Message):
     try:
         await message.answer(
@@ -72,14 +145,21 @@ async def help_command(message: Message):
 
     except Exception as e:
         logger.error(f"Error in help command: {e}")
-@dp.message(Command("my_values"))
-async def show_user_values(message: Message):
+@router.message(Command("my_values"))
+async def show_user_values(message: Message, command: CommandObject, bot_app: App):
+    app = bot_app
     try:
         user_id = message.from_user.id
-        values = await get_user_values(user_id)
+        values = await load_user_values(app, user_id)
         if values:
-            values_text = "\n".join([f"• {value}" for value in values])
-            await message.answer(f"Your saved valuables: \n{values_text}")
+            page_size = app.settings.USER_VALUES_PAGE_SIZE
+            pages = (len(values) + page_size - 1) // page_size
+            page = int(command.args) if command.args and command.args.strip().isdigit() else 1
+            page = min(max(page, 1), pages)
+            chunk = values[(page - 1) * page_size:page * page_size]
+            values_text = "\n".join([f"• {value} ×{count}" for value, count in chunk])
+            footer = f"\nPage {page}/{pages}. Type /my_values <page> to see more." if pages > 1 else ""
+            await message.answer(f"Your saved valuables: \n{values_text}{footer}")
         else:
             await message.answer("You don't have any stored valuables yet.")
     except Exception as e:
@@ -87,58 +167,318 @@ async def show_user_values(message: Message):
         await message.answer(f'Error: {e}')
 
 
-@dp.message(lambda message: message.voice is not None)
-@dp.message(lambda message: message.voice is not None)
-async def handle_voice(message: Message, state: FSMContext):
+async def answer_voice_stream(app: App, chat_id: int, user_id: int, text: str, key: str):
+    openai_service = app.openai_service
+    segments: asyncio.Queue = asyncio.Queue()
+
+    async def synthesize():
+        sentences = []
+        try:
+            async for sentence in openai_service.stream_answer(user_id, text):
+                sentences.append(sentence)
+                await segments.put(asyncio.create_task(openai_service.text_to_voice(sentence)))
+            await app.idempotency.save_checkpoint(key, {"answer": " ".join(sentences)})
+        finally:
+            await segments.put(None)
+
+    producer = asyncio.create_task(synthesize())
+    sent = []
+    try:
+        part = 0
+        while (segment := await segments.get()) is not None:
+            audio = await segment
+            part += 1
+            async with track_stage("answer_voice"):
+                sent.append(await app.bot.send_voice(
+                    chat_id,
+                    voice=BufferedInputFile(audio, filename=f"response_{part}.ogg"),
+                    caption="Here is your response!" if part == 1 else None,
+                ))
+        await producer
+        return sent
+    finally:
+        producer.cancel()
+        while not segments.empty():
+            segment = segments.get_nowait()
+            if segment is not None:
+                segment.cancel()
+
+
+def voice_file_ids(messages: list[Message]) -> list[str]:
+    return [message.voice.file_id for message in messages if message.voice is not None]
+
+
+async def answer_text_then_voice(app: App, chat_id: int, response: str) -> list[Message]:
+    # The user reads the answer while it is synthesized and uploaded
+    async with track_stage("answer_text"):
+        sent = [await app.bot.send_message(chat_id, response)]
     try:
-        file_id = message.voice.file_id
-        ogg_file_name = f"voice_message_{file_id}.ogg"
+        audio = await app.openai_service.text_to_voice(response)
+        async with track_stage("answer_voice"):
+            sent.append(await app.bot.send_voice(
+                chat_id,
+                voice=BufferedInputFile(audio, filename="response.ogg"),
+                reply_parameters=ReplyParameters(message_id=sent[0].message_id),
+            ))
+    except Exception as e:
+        logger.warning(f"Voice reply failed for chat {chat_id}, answered with text only: {e}")
+    return sent
+
+
+async def answer_voice(app: App, chat_id: int, user_id: int, file_id: str, message_id: int, key: str) -> dict:
+    progressive = app.settings.PROGRESSIVE_REPLIES
+    recording = ChatActionSender.record_voice(chat_id=chat_id, bot=app.bot) if progressive else nullcontext()
+    # The action starts before waiting for the user's earlier messages to finish
+    async with recording, track_stage("handle_voice"), app.scheduler.user_slot(user_id):
+        # A retry after a late failure must not add the prompt to the thread or run the tools again
+        checkpoint = await app.idempotency.load_checkpoint(key)
+        if checkpoint is not None:
+            logger.info(f"Resuming {key} from the saved assistant answer")
+            response = checkpoint["answer"]
+        else:
+            voice = await download_file(app, file_id)
+
+            text = await transcribe_voice(app, voice)
+            if app.settings.STREAMING_REPLIES:
+                sent = await answer_voice_stream(app, chat_id, user_id, text, key)
+                return {"message_id": message_id, "voices": voice_file_ids(sent)}
+            response = await app.openai_service.get_answer(user_id, text)
+            await app.idempotency.save_checkpoint(key, {"answer": response})
+        if progressive:
+            sent = await answer_text_then_voice(app, chat_id, response)
+            return {"message_id": message_id, "voices": voice_file_ids(sent), "text": response}
+        audio = await app.openai_service.text_to_voice(response)
+        audio_reply = BufferedInputFile(audio, filename="response.ogg")
+        async with track_stage("answer_voice"):
+            sent = await app.bot.send_voice(chat_id, voice=audio_reply, caption="Here is your response!")
+        return {"message_id": message_id, "voices": voice_file_ids([sent])}
+
+
+async def process_voice(app: App, chat_id: int, user_id: int, file_id: str, file_unique_id: str, message_id: int):
+    key = f"voice:{user_id}:{file_unique_id}"
+    result, replayed = await app.idempotency.run_once(
+        key, lambda: answer_voice(app, chat_id, user_id, file_id, message_id, key)
+    )
+    # The same message redelivered after it was answered needs no second reply
+    if replayed and result["message_id"] != message_id:
+        logger.info(f"Replaying voice answer for duplicate {file_unique_id} from user {user_id}")
+        text = result.get("text")
+        if text:
+            await app.bot.send_message(chat_id, text)
+        for part, voice_id in enumerate(result["voices"]):
+            caption = "Here is your response!" if part == 0 and not text else None
+            await app.bot.send_voice(chat_id, voice=voice_id, caption=caption)
 
-        await download_file(file_id, ogg_file_name)
 
-        text = await openai_service.voice_to_text(ogg_file_name)
-        response = await openai_service.get_answer(message.from_user.id, text, state)
-        audio_file = await openai_service.text_to_voice(response)
-        audio_reply = FSInputFile(audio_file)
-        logger.info(f"{type(audio_reply)}")
-        await message.answer_voice(voice=audio_reply, caption="Here is your response!")
+async def answer_image(app: App, chat_id: int, user_id: int, file_id: str, file_unique_id: str,
+                       message_id: int) -> dict:
+    async with track_stage("handle_image"), app.scheduler.user_slot(user_id):
+        mood = await get_photo_mood(app, file_id, file_unique_id, user_id)
+    await send_mood(app.bot, chat_id, mood)
+    if mood != MOOD_UNDETECTED:
+        await save_value(user_id, mood)
+    return {"message_id": message_id, "mood": mood}
+
+
+async def send_mood(bot: Bot, chat_id: int, mood: str):
+    if mood != MOOD_UNDETECTED:
+        await bot.send_message(chat_id, f"Настроение на фото: {mood}")
+    else:
+        await bot.send_message(chat_id, 'Я не смог определить настроение на фото')
+
+
+async def process_image(app: App, chat_id: int, user_id: int, file_id: str, file_unique_id: str, message_id: int):
+    result, replayed = await app.idempotency.run_once(
+        f"image:{user_id}:{file_unique_id}",
+        lambda: answer_image(app, chat_id, user_id, file_id, file_unique_id, message_id),
+    )
+    # Replays only answer again, the value was already saved by the first execution
+    if replayed and result["message_id"] != message_id:
+        logger.info(f"Replaying photo mood for duplicate {file_unique_id} from user {user_id}")
+        await send_mood(app.bot, chat_id, result["mood"])
+
+
+async def enqueue_job(app: App, kind: str, message: Message, **payload) -> bool:
+    if app.job_queue is None:
+        return False
+    try:
+        await app.job_queue.enqueue(kind, message.from_user.id, {
+            "chat_id": message.chat.id,
+            "message_id": message.message_id,
+            **payload,
+        })
+        return True
+    except Exception as e:
+        logger.warning(f"Could not enqueue {kind} job, processing inline: {e}")
+        return False
+
+
+@router.message(lambda message: message.voice is not None)
+@router.message(lambda message: message.voice is not None)
+async def handle_voice(message: Message, bot_app: App):
+    app = bot_app
+    try:
+        voice = message.voice
+        if await enqueue_job(app, "voice", message, file_id=voice.file_id, file_unique_id=voice.file_unique_id):
+            return
+        await process_voice(
+            app, message.chat.id, message.from_user.id, voice.file_id, voice.file_unique_id, message.message_id
+        )
     except Exception as e:
         logger.error(f"Error in handle_voice: {e}")
         await message.reply(f'Error: {e}')
-    finally:
-        if 'ogg_file_name' in locals() and os.path.exists(ogg_file_name):
-            os.remove(ogg_file_name)
-            logger.info(f"Temporary file {ogg_file_name} removed .")
-        if 'audio_file' in locals() and os.path.exists(audio_file):
-            os.remove(audio_file)
-            logger.info(f"Temp file {audio_file} removed")
-@dp.message(lambda message: message.photo is not None)
-async def handle_image(message: Message):
+@router.message(lambda message: message.photo is not None)
+async def handle_image(message: Message, bot_app: App):
+    app = bot_app
     try:
-        file_id = message.photo[-1].file_id
-        image_file_name = f"image_{file_id}.jpg"
-
-        await download_file(file_id, image_file_name)
-        image_base64 = await image_to_base64(image_file_name)
-        mood = await openai_service.analyze_mood_from_photo(image_base64, message.from_user.id)
-        if mood!='Не удалось определить настроение.':
-         await message.answer(f"Настроение на фото: {mood}")
-         await save_value(message.from_user.id, mood)
-        else:
-            await message.answer('Я не смог определить настроение на фото')
+        photo = pick_photo_size(message.photo, app.settings.VISION_TARGET_SIDE)
+        if await enqueue_job(app, "image", message, file_id=photo.file_id, file_unique_id=photo.file_unique_id):
+            return
+        await process_image(
+            app, message.chat.id, message.from_user.id, photo.file_id, photo.file_unique_id, message.message_id
+        )
     except Exception as e:
         logger.error(f"Error in handle_image: {e}")
         await message.reply(f'Error: {e}')
+
+
+async def run_voice_job(app: App, job: Job):
+    payload = job.payload
+    await process_voice(
+        app, payload["chat_id"], job.user_id, payload["file_id"], payload["file_unique_id"], payload["message_id"]
+    )
+
+
+async def run_image_job(app: App, job: Job):
+    payload = job.payload
+    await process_image(
+        app, payload["chat_id"], job.user_id, payload["file_id"], payload["file_unique_id"], payload["message_id"]
+    )
+
+
+async def on_job_failed(app: App, job: Job, error: Exception):
+    await app.bot.send_message(
+        job.payload["chat_id"],
+        f'Error: {error}',
+        reply_parameters=ReplyParameters(message_id=job.payload["message_id"], allow_sending_without_reply=True),
+    )
+
+
+def job_handlers(app: App) -> dict:
+    return {"voice": partial(run_voice_job, app), "image": partial(run_image_job, app)}
+
+
+async def on_startup(bot_app: App, bot: Bot, dispatcher: Dispatcher):
+    await bot_app.start()
+    settings = bot_app.settings
+    if settings.BOT_MODE == "webhook":
+        await bot.set_webhook(
+            url=f"{settings.WEBHOOK_BASE_URL.rstrip('/')}{settings.WEBHOOK_PATH}",
+            secret_token=settings.WEBHOOK_SECRET or None,
+            max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+        logger.info(f"Webhook set to {settings.WEBHOOK_BASE_URL}{settings.WEBHOOK_PATH}")
+
+
+async def on_shutdown(bot_app: App):
+    await bot_app.stop()
+
+
+def create_dispatcher(app: App) -> Dispatcher:
+    # "app" is taken by the aiohttp application in webhook mode
+    dp = Dispatcher(storage=app.storage, bot_app=app)
+    dp.update.outer_middleware(skip_redelivered_updates)
+    dp.update.outer_middleware(track_in_flight)
+    dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def readyz(request: web.Request) -> web.Response:
+    checks = await request.app[APP_KEY].check_ready()
+    return web.json_response(checks, status=200 if all(checks.values()) else 503)
+
+
+async def stats(request: web.Request) -> web.Response:
+    app = request.app[APP_KEY]
+    openai_service = app.openai_service
+    return web.json_response({
+        "ready": app.ready,
+        "in_flight": len(app.in_flight),
+        "scheduler": app.scheduler.snapshot(),
+        "idempotency": app.idempotency.stats,
+        "caches": {
+            cache.namespace: cache.stats
+            for cache in (openai_service.validation_cache, app.mood_cache, app.user_values_cache,
+                          openai_service.audio_cache)
+        },
+    })
+
+
+def add_probes(web_app: web.Application, app: App):
+    web_app[APP_KEY] = app
+    web_app.router.add_get("/healthz", healthz)
+    web_app.router.add_get("/readyz", readyz)
+    web_app.router.add_get("/stats", stats)
+    web_app.router.add_get("/metrics", metrics_handler)
+
+
+def run_webhook(app: App):
+    settings = app.settings
+    dp = create_dispatcher(app)
+    web_app = web.Application()
+    add_probes(web_app, app)
+    # Dispatcher shutdown hooks must run before the request handler closes the bot session,
+    # otherwise draining updates can no longer reply.
+    setup_application(web_app, dp, bot=app.bot)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=app.bot,
+        secret_token=settings.WEBHOOK_SECRET or None,
+    ).register(web_app, path=settings.WEBHOOK_PATH)
+    logger.info("Starting bot in webhook mode")
+    web.run_app(
+        web_app,
+        host=settings.WEB_SERVER_HOST,
+        port=settings.WEB_SERVER_PORT,
+        shutdown_timeout=settings.SHUTDOWN_TIMEOUT,
+    )
+
+
+async def start_metrics_server(app: App) -> web.AppRunner:
+    web_app = web.Application()
+    add_probes(web_app, app)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, app.settings.WEB_SERVER_HOST, app.settings.METRICS_PORT).start()
+    logger.info(f"Metrics available on port {app.settings.METRICS_PORT}")
+    return runner
+
+
+async def run_polling(app: App):
+    logger.info("Starting bot in polling mode")
+    dp = create_dispatcher(app)
+    metrics_runner = await start_metrics_server(app)
+    try:
+        await dp.start_polling(app.bot)
     finally:
-        if 'image_file_name' in locals() and os.path.exists(image_file_name):
-            os.remove(image_file_name)
-            logger.info(f"Temporary file {image_file_name} removed.")
+        await metrics_runner.cleanup()
+
 
-async def main():
-    await init_db()
-    logger.info("Starting bot")
-    await dp.start_polling(bot)
+def main():
+    setup_logging()
+    app = create_app()
+    if app.settings.BOT_MODE == "webhook":
+        run_webhook(app)
+    else:
+        asyncio.run(run_polling(app))
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    main()
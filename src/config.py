@@ -1,3 +1,7 @@
+from functools import lru_cache
+from typing import Literal
+
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
 
@@ -6,8 +10,10 @@ class Settings(BaseSettings):
     OPENAI_API_KEY: str
     OPENAI_ASSISTANT_ID: str
     OPENAI_AMPLITUDE_KEY: str
+    TELEGRAM_API_URL: str = ""
+    OPENAI_BASE_URL: str = ""
 
-    # Redis
+    # Redis (an empty host disables Redis and keeps caches and FSM in memory)
     REDIS_HOST: str
     REDIS_PORT: int
     REDIS_PASSWORD: str
@@ -19,9 +25,120 @@ class Settings(BaseSettings):
     MYSQL_DATABASE: str
     MYSQL_USER: str
     MYSQL_PASSWORD: str
+    DATABASE_URL: str = ""
+    DATABASE_ECHO: bool = True
+    DATABASE_CREATE_TABLES: bool = True
+    VALUE_FLUSH_BATCH_SIZE: int = 200
+    VALUE_FLUSH_INTERVAL: float = 2.0
+    USER_VALUES_LIMIT: int = 500
+    USER_VALUES_PAGE_SIZE: int = 20
+    USER_VALUES_CACHE_TTL: int = 3600
+    USER_VALUES_LOCAL_TTL: float = 10.0
+
+    # Update delivery
+    BOT_MODE: Literal["polling", "webhook"] = "polling"
+    WEBHOOK_BASE_URL: str = ""
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str = ""
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    WEB_SERVER_HOST: str = "0.0.0.0"
+    WEB_SERVER_PORT: int = 8080
+    SHUTDOWN_TIMEOUT: float = 30.0
+    STARTUP_BUDGET: float = 1.0
+    METRICS_PORT: int = 9090
+
+    # Replies
+    STREAMING_REPLIES: bool = False
+    # Show a recording action at once and send the text answer before its voice note
+    PROGRESSIVE_REPLIES: bool = False
+
+    # Duplicate updates and media
+    IDEMPOTENCY_UPDATE_TTL: int = 24 * 3600
+    IDEMPOTENCY_RESULT_TTL: int = 600
+    IDEMPOTENCY_PENDING_TTL: int = 300
+
+    # Media job queue (needs Redis, handlers process media inline when it is disabled)
+    JOB_QUEUE_ENABLED: bool = False
+    JOB_SHARDS: int = 16
+    JOB_WORKERS: int = 2
+    JOB_WORKER_CONCURRENCY: int = 8
+    # 0 spreads the shards evenly over the live workers, a fixed limit leaves the rest to other nodes
+    JOB_MAX_SHARDS_PER_WORKER: int = 0
+    JOB_VISIBILITY_TIMEOUT: float = 180.0
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_RETRY_DELAY: float = 2.0
+    JOB_STREAM_MAXLEN: int = 100_000
+    JOB_LEASE_TTL: float = 30.0
+
+    # OpenAI
+    TOOL_CALL_CONCURRENCY: int = 4
+    STT_CONCURRENCY: int = 8
+    ASSISTANT_CONCURRENCY: int = 16
+    TTS_CONCURRENCY: int = 8
+    VISION_CONCURRENCY: int = 4
+    CHAT_CONCURRENCY: int = 16
+    USER_LOCK_TIMEOUT: float = 180.0
+    STT_RPM: int = 500
+    TTS_RPM: int = 500
+    CHAT_RPM: int = 5000
+    VISION_RPM: int = 5000
+    THREADS_RPM: int = 3000
+    FILES_RPM: int = 1000
+    OPENAI_REQUEST_DEADLINE: float = 60.0
+    OPENAI_HEDGE_DELAY: float = 2.0
+    OPENAI_RUN_POLL_INTERVAL: float = 0.5
+    OPENAI_RUN_TIMEOUT: float = 120.0
+    THREAD_REGISTRY_SIZE: int = 10000
+    THREAD_IDLE_TTL: int = 7 * 24 * 3600
+    THREAD_COMPACT_AFTER_TURNS: int = 20
+    THREAD_COMPACT_HISTORY_MESSAGES: int = 40
+    THREAD_COMPACTION_MODEL: str = "gpt-4o-mini"
+    RUN_TRUNCATION_MESSAGES: int = 20
+    VALIDATION_CACHE_SIZE: int = 2048
+    VALIDATION_CACHE_TTL: int = 7 * 24 * 3600
+    PHOTO_MOOD_CACHE_SIZE: int = 4096
+    PHOTO_MOOD_CACHE_TTL: int = 3 * 24 * 3600
+    VISION_TARGET_SIDE: int = 768
+    VISION_JPEG_QUALITY: int = 85
+    VISION_DETAIL: Literal["low", "high", "auto"] = "low"
+
+    # Voice preprocessing (needs ffmpeg, raw audio is sent when it is missing)
+    AUDIO_PREPROCESSING: bool = True
+    AUDIO_SAMPLE_RATE: int = 16000
+    AUDIO_BITRATE: str = "24k"
+    AUDIO_SILENCE_THRESHOLD: str = "-40dB"
+    AUDIO_MIN_SILENCE: float = 0.4
+    STT_CHUNK_SECONDS: float = 60.0
+
+    # Text to speech
+    TTS_MODEL: str = "tts-1"
+    TTS_VOICE: str = "alloy"
+    TTS_FORMAT: str = "opus"
+    TTS_CACHE_DIR: str = "tts_cache"
+    TTS_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    TTS_PREWARM: bool = True
+    TTS_PREWARM_TEXTS: list[str] = []
+
+    # Analytics
+    ANALYTICS_QUEUE_SIZE: int = 1000
+    ANALYTICS_BATCH_SIZE: int = 50
+    ANALYTICS_FLUSH_INTERVAL: float = 5.0
+    ANALYTICS_MAX_PROPERTY_LENGTH: int = 1024
+
+    @model_validator(mode="after")
+    def build_database_url(self):
+        if not self.DATABASE_URL:
+            self.DATABASE_URL = (
+                f"mysql+aiomysql://{self.MYSQL_USER}:{self.MYSQL_PASSWORD}"
+                f"@{self.MYSQL_HOST}:{self.MYSQL_PORT}/{self.MYSQL_DATABASE}"
+            )
+        return self
+
     class Config:
         env_file = '../.env'
         env_file_encoding = "utf-8"
 
 
-settings = Settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    return Settings()
\ No newline at end of file
@@ -1,17 +1,34 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from src.database.models import Base
-from src.config import settings
+from src.config import get_settings
 
+_engine: AsyncEngine | None = None
+_sessionmaker: async_sessionmaker | None = None
 
-DATABASE_URL = settings.DATABASE_URL
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+def get_engine() -> AsyncEngine:
+    # Created on first use; the driver only connects when a session needs it
+    global _engine, _sessionmaker
+    if _engine is None:
+        settings = get_settings()
+        _engine = create_async_engine(settings.DATABASE_URL, echo=settings.DATABASE_ECHO)
+        _sessionmaker = async_sessionmaker(bind=_engine, expire_on_commit=False)
+    return _engine
+
+
+def get_session():
+    get_engine()
+    return _sessionmaker()
+
+
+async def dispose_engine():
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+        _sessionmaker = None
 
-AsyncSessionLocal = async_sessionmaker(
-    bind=engine,
-    expire_on_commit=False,
-)
 
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
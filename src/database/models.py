@@ -1,19 +1,35 @@
+from datetime import datetime
+
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Integer, ForeignKey
+from sqlalchemy import BigInteger, DateTime, ForeignKey, Index, Integer, String, func
+from sqlalchemy.dialects import mysql
+
+# SQLite only auto-increments INTEGER PRIMARY KEY columns
+ID = BigInteger().with_variant(Integer, "sqlite")
+VALUE_MAX_LENGTH = 255
+# Values are normalised before lookup; a binary collation makes MySQL compare them the same way the code does
+VALUE_TEXT = String(VALUE_MAX_LENGTH).with_variant(
+    mysql.VARCHAR(VALUE_MAX_LENGTH, charset="utf8mb4", collation="utf8mb4_bin"), "mysql", "mariadb"
+)
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
-class User(Base):
-    __tablename__ = "users"
+class ValueDictionary(Base):
+    __tablename__ = "value_dictionary"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    username: Mapped[str] = mapped_column(String, nullable=False)
+    id: Mapped[int] = mapped_column(ID, primary_key=True, autoincrement=True)
+    value: Mapped[str] = mapped_column(VALUE_TEXT, nullable=False, unique=True)
 
 class UserValue(Base):
     __tablename__ = "user_values"
+    __table_args__ = (
+        # Covers get_user_values: filter by user, order by count, then join the value names
+        Index("ix_user_values_user_count", "user_id", "count", "value_id"),
+    )
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
-    value: Mapped[str] = mapped_column(String, nullable=False)
\ No newline at end of file
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    value_id: Mapped[int] = mapped_column(ID, ForeignKey("value_dictionary.id"), primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+    last_seen: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now())
@@ -1,32 +1,201 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from typing import Awaitable, Callable
+
 from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+logger = logging.getLogger(__name__)
+
+
+class ValueWriteBuffer:
+    def __init__(self, batch_size: int = 200, flush_interval: float = 2.0, max_pending: int = 10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # (user_id, value) -> occurrences and last time seen since the previous flush
+        self.pending: dict[tuple[int, str], tuple[int, datetime]] = {}
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self.on_flush: list[Callable[[set[int]], Awaitable[None]]] = []
+
+    def configure(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    def add(self, user_id: int, value: str, count: int = 1, seen: datetime | None = None):
+        key = (user_id, value)
+        previous, _ = self.pending.get(key, (0, None))
+        self.pending[key] = (previous + count, seen or datetime.now(timezone.utc).replace(tzinfo=None))
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if await self.flush():
+                failures = 0
+            else:
+                # Back off while the database is down instead of retrying on every full batch
+                failures += 1
+                await asyncio.sleep(min(self.flush_interval * 2 ** (failures - 1), 60))
+
+    async def flush(self) -> bool:
+        from src.database.database import get_session
+        async with self._lock:
+            if not self.pending:
+                return True
+            rows = self.pending
+            self.pending = {}
+            try:
+                async with get_session() as session:
+                    await upsert_user_values(session, rows)
+                    await session.commit()
+                logger.info(f"Flushed {len(rows)} values to the database.")
+            except Exception as e:
+                logger.error(f"Error flushing values: {e}")
+                if len(self.pending) + len(rows) <= self.max_pending:
+                    # Merged back without add(), which would wake the flush loop right away
+                    for key, (count, seen) in rows.items():
+                        previous, previous_seen = self.pending.get(key, (0, seen))
+                        self.pending[key] = (previous + count, max(seen, previous_seen))
+                else:
+                    logger.error(f"Dropped {len(rows)} values, write buffer is full.")
+                return False
+
+        user_ids = {user_id for user_id, _ in rows}
+        for callback in self.on_flush:
+            try:
+                await callback(user_ids)
+            except Exception as e:
+                logger.error(f"Error in flush callback: {e}")
+        return True
+
+
+def dialect_insert(session, table):
+    dialect = session.bind.dialect.name
+    if dialect in ("mysql", "mariadb"):
+        return mysql_insert(table)
+    if dialect == "postgresql":
+        return postgresql_insert(table)
+    return sqlite_insert(table)
 
-async def get_user_values(user_id: int) -> list[str]:
-    from src.bot import logger
-    from src.database.database import AsyncSessionLocal
-    from src.database.models import UserValue
+
+async def value_ids(session, values: set[str]) -> dict[str, int]:
+    from src.database.models import ValueDictionary
+
+    async def lookup(keys: set[str]) -> dict[str, int]:
+        result = await session.execute(
+            select(ValueDictionary.value, ValueDictionary.id).where(ValueDictionary.value.in_(keys))
+        )
+        # Only exact matches count, a column compared under another collation may return other spellings
+        return {value: value_id for value, value_id in result.all() if value in keys}
+
+    ids = await lookup(values)
+    missing = values - ids.keys()
+    if missing:
+        stmt = dialect_insert(session, ValueDictionary)
+        if session.bind.dialect.name in ("mysql", "mariadb"):
+            stmt = stmt.prefix_with("IGNORE")
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[ValueDictionary.value])
+        await session.execute(stmt, [{"value": value} for value in missing])
+        ids.update(await lookup(missing))
+    unresolved = values - ids.keys()
+    if unresolved:
+        logger.error(f"Could not store dictionary entries for {sorted(unresolved)}")
+    return ids
+
+
+def value_key(value: str) -> str:
+    # "Семья", " семья " and "СЕМЬЯ" are one dictionary entry
+    return " ".join(value.casefold().replace("ё", "е").split())
+
+
+async def upsert_user_values(session, rows: dict[tuple[int, str], tuple[int, datetime]]):
+    from src.database.models import VALUE_MAX_LENGTH, UserValue
+    merged: dict[tuple[int, str], tuple[int, datetime]] = {}
+    for (user_id, value), (count, seen) in rows.items():
+        normalized = value_key(value)[:VALUE_MAX_LENGTH].rstrip()
+        if not normalized:
+            logger.warning(f"Skipped empty value for user {user_id}")
+            continue
+        key = (user_id, normalized)
+        previous, previous_seen = merged.get(key, (0, seen))
+        merged[key] = (previous + count, max(seen, previous_seen))
+    if not merged:
+        return
+    ids = await value_ids(session, {value for _, value in merged})
+
+    stmt = dialect_insert(session, UserValue)
+    if session.bind.dialect.name in ("mysql", "mariadb"):
+        stmt = stmt.on_duplicate_key_update(
+            count=UserValue.count + stmt.inserted["count"],
+            last_seen=stmt.inserted.last_seen,
+        )
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserValue.user_id, UserValue.value_id],
+            set_={"count": UserValue.count + stmt.excluded["count"], "last_seen": stmt.excluded.last_seen},
+        )
+    params = [
+        {"user_id": user_id, "value_id": ids[value], "count": count, "last_seen": seen}
+        for (user_id, value), (count, seen) in merged.items()
+        if value in ids
+    ]
+    if len(params) < len(merged):
+        logger.error(f"Dropped {len(merged) - len(params)} values without a dictionary entry")
+    if params:
+        await session.execute(stmt, params)
+
+
+value_writer = ValueWriteBuffer()
+
+
+async def get_user_values(user_id: int, limit: int = 500) -> list[tuple[str, int]] | None:
+    from src.database.database import get_session
+    from src.database.models import UserValue, ValueDictionary
     try:
-        async with AsyncSessionLocal() as session:
+        async with get_session() as session:
             result = await session.execute(
-                select(UserValue.value)
+                select(ValueDictionary.value, UserValue.count)
+                .select_from(UserValue)
+                .join(ValueDictionary, ValueDictionary.id == UserValue.value_id)
                 .where(UserValue.user_id == user_id)
+                .order_by(UserValue.count.desc(), UserValue.value_id)
+                .limit(limit)
             )
-            values = result.scalars().all()
+            values = [(value, count) for value, count in result.all()]
             logger.info(f"Retrieved {len(values)} values for user {user_id}")
             return values
     except Exception as e:
         logger.error(f"Error in get_user_values: {e}")
-        return []
+        return None
 
 async def save_value(user_id: int, value: str):
-    from src.bot import logger
-    from src.database.database import AsyncSessionLocal
-    from src.database.models import UserValue
-    try:
-        async with AsyncSessionLocal() as session:
-            new_value = UserValue(user_id=user_id, value=value)
-            session.add(new_value)
-            await session.commit()
-            logger.info(f"Value '{value}' saved to the database for the user {user_id}.")
-    except Exception as e:
-        logger.error(f"Error in save_value: {e}")
-        raise
\ No newline at end of file
+    value_writer.add(user_id, value)
+    logger.info(f"Value '{value}' queued for the user {user_id}.")
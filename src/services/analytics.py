@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+
+from amplitude import Amplitude, BaseEvent
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsClient:
+    def __init__(self, api_key: str | None, queue_size: int = 1000, batch_size: int = 50,
+                 flush_interval: float = 5.0, max_property_length: int = 1024):
+        self.amplitude = Amplitude(api_key=api_key) if api_key else None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_property_length = max_property_length
+        self.dropped = 0
+        self._task: asyncio.Task | None = None
+
+    def track(self, event_type: str, user_id: int | str, properties: dict | None = None):
+        if self.amplitude is None:
+            return
+        event = BaseEvent(
+            event_type=event_type,
+            user_id=str(user_id),
+            event_properties=self._cap_properties(properties or {}),
+        )
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"Analytics queue is full, {self.dropped} events dropped so far")
+
+    def _cap_properties(self, properties: dict) -> dict:
+        capped = {}
+        for key, value in properties.items():
+            size = len(value) if isinstance(value, str) else len(json.dumps(value, default=str))
+            if size > self.max_property_length:
+                logger.warning(f"Analytics property '{key}' dropped: {size} chars")
+                value = f"<dropped: {size} chars>"
+            capped[key] = value
+        return capped
+
+    async def start(self):
+        if self.amplitude is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Analytics flusher started")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+        await asyncio.to_thread(self.amplitude.shutdown)
+        logger.info("Analytics flusher stopped")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            event = await self.queue.get()
+            if event is None:
+                break
+            batch = [event]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            await self._send(batch)
+
+    async def _send(self, batch: list[BaseEvent]):
+        try:
+            await asyncio.to_thread(self._send_sync, batch)
+            logger.info(f"Flushed {len(batch)} analytics events")
+        except Exception as e:
+            logger.error(f"Error flushing analytics batch: {e}")
+
+    def _send_sync(self, batch: list[BaseEvent]):
+        for event in batch:
+            self.amplitude.track(event)
+        self.amplitude.flush()
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+from redis.asyncio import Redis
+
+from src.utils.logger import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    def __init__(self, max_size: int = 1024, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Writes a read-through value only if nothing invalidated the key since the read started
+SET_IF_GENERATION_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') == ARGV[2] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class TwoTierCache:
+    def __init__(self, redis: Redis | None, namespace: str, max_size: int = 1024, ttl: int = 86400,
+                 local_ttl: float | None = None):
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LRUCache(max_size=max_size, ttl=local_ttl)
+        self.local_generations = LRUCache(max_size=max_size)
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+        self._set_if_generation = redis.register_script(SET_IF_GENERATION_SCRIPT) if redis is not None else None
+
+    def _redis_key(self, key: str) -> str:
+        return f"cache:{self.namespace}:{key}"
+
+    def _generation_key(self, key: str) -> str:
+        return f"cache:{self.namespace}:{key}:generation"
+
+    async def get(self, key: str) -> Any | None:
+        value = self.local.get(key)
+        if value is not None:
+            self.stats["local_hits"] += 1
+            CACHE_REQUESTS.labels(self.namespace, "local_hit").inc()
+            return value
+
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(self._redis_key(key))
+            except Exception as e:
+                logger.warning(f"Redis read failed for {self.namespace} cache: {e}")
+                raw = None
+            if raw is not None:
+                value = json.loads(raw)
+                self.local.set(key, value)
+                self.stats["redis_hits"] += 1
+                CACHE_REQUESTS.labels(self.namespace, "redis_hit").inc()
+                return value
+
+        self.stats["misses"] += 1
+        CACHE_REQUESTS.labels(self.namespace, "miss").inc()
+        return None
+
+    async def set(self, key: str, value: Any, generation: int | None = None):
+        # With a generation from before the read, the value is dropped if the key was invalidated meanwhile
+        if generation is not None and generation != (self.local_generations.get(key) or 0):
+            return
+        if self.redis is not None:
+            try:
+                raw = json.dumps(value, ensure_ascii=False)
+                if generation is None:
+                    await self.redis.set(self._redis_key(key), raw, ex=self.ttl)
+                elif not await self._set_if_generation(
+                    keys=[self._redis_key(key), self._generation_key(key)], args=[raw, generation, self.ttl]
+                ):
+                    return
+            except Exception as e:
+                logger.warning(f"Redis write failed for {self.namespace} cache: {e}")
+                return
+        self.local.set(key, value)
+
+    async def generation(self, key: str) -> int:
+        if self.redis is None:
+            return self.local_generations.get(key) or 0
+        try:
+            raw = await self.redis.get(self._generation_key(key))
+        except Exception as e:
+            logger.warning(f"Redis read failed for {self.namespace} cache: {e}")
+            return -1
+        generation = int(raw or 0)
+        self.local_generations.set(key, generation)
+        return generation
+
+    async def invalidate(self, key: str):
+        self.local_generations.set(key, (self.local_generations.get(key) or 0) + 1)
+        self.local.delete(key)
+        if self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.incr(self._generation_key(key))
+                    # Outlives every value written under an older generation
+                    pipe.expire(self._generation_key(key), self.ttl * 2)
+                    pipe.delete(self._redis_key(key))
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning(f"Redis invalidation failed for {self.namespace} cache: {e}")
+
+    async def delete(self, key: str):
+        self.local.delete(key)
+        if self.redis is not None:
+            try:
+                await self.redis.delete(self._redis_key(key))
+            except Exception as e:
+                logger.warning(f"Redis delete failed for {self.namespace} cache: {e}")
+
+
+class DiskCache:
+    def __init__(self, directory: str, namespace: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key
+
+    def _load(self):
+        # Rebuild the LRU order from file access times so the cache survives restarts
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = [path for path in self.directory.iterdir() if path.is_file() and not path.name.endswith(".tmp")]
+        for path in sorted(files, key=lambda p: p.stat().st_mtime):
+            size = path.stat().st_size
+            self._entries[path.name] = size
+            self.size += size
+        self._unlink(self._pop_oldest())
+        self._loaded = True
+
+    def _pop_oldest(self) -> list[str]:
+        evicted = []
+        while self.size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            self.stats["evictions"] += 1
+            evicted.append(key)
+        return evicted
+
+    def _unlink(self, keys: list[str]):
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+
+    def _read(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            content = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return content
+
+    def _write(self, key: str, content: bytes):
+        path = self._path(key)
+        tmp = path.with_name(f"{key}.tmp")
+        tmp.write_bytes(content)
+        os.replace(tmp, path)
+
+    async def load(self):
+        if not self._loaded:
+            async with self._lock:
+                if not self._loaded:
+                    await asyncio.to_thread(self._load)
+
+    async def get(self, key: str) -> bytes | None:
+        try:
+            await self.load()
+            content = await asyncio.to_thread(self._read, key) if key in self._entries else None
+        except Exception as e:
+            logger.warning(f"Disk read failed for {self.namespace} cache: {e}")
+            content = None
+        if content is None:
+            # The file may have been evicted by another process sharing the directory
+            self.size -= self._entries.pop(key, 0)
+            self.stats["misses"] += 1
+            CACHE_REQUESTS.labels(self.namespace, "miss").inc()
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        CACHE_REQUESTS.labels(self.namespace, "disk_hit").inc()
+        return content
+
+    async def set(self, key: str, content: bytes):
+        if len(content) > self.max_bytes:
+            return
+        try:
+            await self.load()
+            await asyncio.to_thread(self._write, key, content)
+        except Exception as e:
+            logger.warning(f"Disk write failed for {self.namespace} cache: {e}")
+            return
+        self.size += len(content) - self._entries.pop(key, 0)
+        self._entries[key] = len(content)
+        evicted = self._pop_oldest()
+        if evicted:
+            await asyncio.to_thread(self._unlink, evicted)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
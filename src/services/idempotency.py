@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import time
+
+from redis.asyncio import Redis
+
+from src.services.cache import LRUCache
+from src.utils.logger import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+
+
+class Idempotency:
+    def __init__(self, redis: Redis | None, prefix: str = "idem", update_ttl: int = 24 * 3600,
+                 result_ttl: int = 600, pending_ttl: int = 300, poll_interval: float = 0.5,
+                 max_size: int = 10000):
+        self.redis = redis
+        self.prefix = prefix
+        self.update_ttl = update_ttl
+        self.result_ttl = result_ttl
+        self.pending_ttl = pending_ttl
+        self.poll_interval = poll_interval
+        self.local_updates = LRUCache(max_size=max_size, ttl=update_ttl)
+        self.local_results = LRUCache(max_size=max_size, ttl=result_ttl)
+        self.local_checkpoints = LRUCache(max_size=max_size, ttl=result_ttl)
+        self.flights: dict[str, asyncio.Future] = {}
+        self.stats = {"duplicate_updates": 0, "joined": 0, "replayed": 0, "executed": 0}
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def first_delivery(self, update_id: int) -> bool:
+        key = f"update:{update_id}"
+        if self.local_updates.get(key) is not None:
+            first = False
+        elif self.redis is not None:
+            try:
+                first = bool(await self.redis.set(self._key(key), 1, nx=True, ex=self.update_ttl))
+            except Exception as e:
+                logger.warning(f"Could not check update {update_id} for redelivery: {e}")
+                first = True
+        else:
+            first = True
+        self.local_updates.set(key, True)
+        if not first:
+            self.stats["duplicate_updates"] += 1
+            CACHE_REQUESTS.labels("idempotency", "duplicate_update").inc()
+        return first
+
+    async def run_once(self, key: str, fn) -> tuple[dict, bool]:
+        # Returns the result and whether it came from another execution
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.stats["joined"] += 1
+            CACHE_REQUESTS.labels("idempotency", "joined").inc()
+            return await asyncio.shield(flight), True
+
+        flight = asyncio.get_running_loop().create_future()
+        self.flights[key] = flight
+        try:
+            result = await self._run_once(key, fn)
+            flight.set_result(result[0])
+            return result
+        except BaseException as e:
+            flight.set_exception(e)
+            # Nobody may be waiting, which would otherwise log "exception was never retrieved"
+            flight.exception()
+            raise
+        finally:
+            del self.flights[key]
+
+    async def _run_once(self, key: str, fn) -> tuple[dict, bool]:
+        result = self.local_results.get(key)
+        if result is not None:
+            return self._replayed(result)
+
+        if self.redis is None:
+            result = await self._execute(fn)
+            self.local_results.set(key, result)
+            return result, False
+
+        deadline = time.monotonic() + self.pending_ttl
+        while True:
+            try:
+                claimed = await self.redis.set(self._key(key), PENDING, nx=True, ex=self.pending_ttl)
+                raw = None if claimed else await self.redis.get(self._key(key))
+            except Exception as e:
+                logger.warning(f"Idempotency store unavailable for {key}, executing anyway: {e}")
+                return await self._execute(fn), False
+
+            if claimed:
+                break
+            if raw is not None and raw not in (PENDING, PENDING.encode()):
+                result = json.loads(raw)
+                self.local_results.set(key, result)
+                return self._replayed(result)
+            if time.monotonic() > deadline:
+                logger.warning(f"Gave up waiting for another worker to finish {key}")
+                return await self._execute(fn), False
+            # Another process is working on it; its result shows up under the same key
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            result = await self._execute(fn)
+        except BaseException:
+            try:
+                await self.redis.delete(self._key(key))
+            except Exception as e:
+                logger.warning(f"Could not release idempotency key {key}: {e}")
+            raise
+        self.local_results.set(key, result)
+        try:
+            await self.redis.set(self._key(key), json.dumps(result, ensure_ascii=False), ex=self.result_ttl)
+        except Exception as e:
+            logger.warning(f"Could not store result for {key}: {e}")
+        return result, False
+
+    async def _execute(self, fn) -> dict:
+        self.stats["executed"] += 1
+        CACHE_REQUESTS.labels("idempotency", "executed").inc()
+        return await fn()
+
+    def _replayed(self, result: dict) -> tuple[dict, bool]:
+        self.stats["replayed"] += 1
+        CACHE_REQUESTS.labels("idempotency", "replayed").inc()
+        return result, True
+
+    async def save_checkpoint(self, key: str, state: dict):
+        # Progress of an execution that failed later, so a retry can skip the steps that must not repeat
+        self.local_checkpoints.set(key, state)
+        if self.redis is not None:
+            try:
+                await self.redis.set(
+                    self._key(f"checkpoint:{key}"), json.dumps(state, ensure_ascii=False), ex=self.result_ttl
+                )
+            except Exception as e:
+                logger.warning(f"Could not store checkpoint for {key}: {e}")
+
+    async def load_checkpoint(self, key: str) -> dict | None:
+        state = self.local_checkpoints.get(key)
+        if state is not None or self.redis is None:
+            return state
+        try:
+            raw = await self.redis.get(self._key(f"checkpoint:{key}"))
+        except Exception as e:
+            logger.warning(f"Could not read checkpoint for {key}: {e}")
+            return None
+        return json.loads(raw) if raw is not None else None
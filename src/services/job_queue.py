@@ -0,0 +1,376 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import socket
+import time
+import uuid
+from dataclasses import dataclass
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+from src.utils.logger import JOB_QUEUE_WAIT, JOBS
+
+logger = logging.getLogger(__name__)
+
+# Extends a lease only while we still own it
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+@dataclass
+class Job:
+    id: str
+    shard: int
+    kind: str
+    user_id: int
+    payload: dict
+    enqueued_at: float
+    attempt: int = 1
+
+    @classmethod
+    def from_entry(cls, shard: int, entry_id, fields: dict) -> "Job":
+        fields = {_text(key): _text(value) for key, value in fields.items()}
+        return cls(
+            id=_text(entry_id),
+            shard=shard,
+            kind=fields["kind"],
+            user_id=int(fields["user_id"]),
+            payload=json.loads(fields["payload"]),
+            enqueued_at=float(fields.get("enqueued_at", 0)),
+        )
+
+
+class JobQueue:
+    def __init__(self, redis: Redis, shards: int = 16, prefix: str = "jobs", group: str = "workers",
+                 visibility_timeout: float = 120.0, max_attempts: int = 3, maxlen: int = 100_000,
+                 lease_ttl: float = 30.0):
+        self.redis = redis
+        self.shards = shards
+        self.prefix = prefix
+        self.group = group
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.maxlen = maxlen
+        self.lease_ttl = lease_ttl
+        self._renew_lease = redis.register_script(RENEW_LEASE_SCRIPT)
+        self._release_lease = redis.register_script(RELEASE_LEASE_SCRIPT)
+
+    def stream(self, shard: int) -> str:
+        return f"{self.prefix}:{shard}"
+
+    @property
+    def dead_stream(self) -> str:
+        return f"{self.prefix}:dead"
+
+    def shard_for(self, user_id: int) -> int:
+        return user_id % self.shards
+
+    async def enqueue(self, kind: str, user_id: int, payload: dict) -> str:
+        # A user's jobs always land on the same shard, and a shard has a single consumer,
+        # so they are processed in the order they arrived
+        job_id = await self.redis.xadd(
+            self.stream(self.shard_for(user_id)),
+            {
+                "kind": kind,
+                "user_id": user_id,
+                "payload": json.dumps(payload, ensure_ascii=False),
+                "enqueued_at": time.time(),
+            },
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+        JOBS.labels(kind, "enqueued").inc()
+        return _text(job_id)
+
+    async def ensure_group(self, shard: int):
+        try:
+            await self.redis.xgroup_create(self.stream(shard), self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def acquire_lease(self, shard: int, owner: str) -> bool:
+        key = f"{self.prefix}:lease:{shard}"
+        ttl = int(self.lease_ttl * 1000)
+        if await self._renew_lease(keys=[key], args=[owner, ttl]):
+            return True
+        return bool(await self.redis.set(key, owner, nx=True, px=ttl))
+
+    async def release_lease(self, shard: int, owner: str):
+        await self._release_lease(keys=[f"{self.prefix}:lease:{shard}"], args=[owner])
+
+    async def register_worker(self, consumer: str) -> int:
+        # Returns how many workers are alive; one that stopped refreshing for a lease period is gone
+        key = f"{self.prefix}:workers"
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(key, {consumer: now})
+            pipe.zremrangebyscore(key, 0, now - self.lease_ttl)
+            pipe.zcard(key)
+            *_, live = await pipe.execute()
+        return live
+
+    async def unregister_worker(self, consumer: str):
+        await self.redis.zrem(f"{self.prefix}:workers", consumer)
+
+    async def read(self, shards: list[int], consumer: str, count: int, block: float = 1.0) -> list[Job]:
+        response = await self.redis.xreadgroup(
+            self.group,
+            consumer,
+            {self.stream(shard): ">" for shard in shards},
+            count=count,
+            block=int(block * 1000),
+        )
+        shard_by_stream = {self.stream(shard): shard for shard in shards}
+        return [
+            Job.from_entry(shard_by_stream[_text(stream)], entry_id, fields)
+            for stream, entries in response or []
+            for entry_id, fields in entries
+        ]
+
+    async def reclaim(self, shard: int, consumer: str, count: int) -> list[Job]:
+        # Entries whose consumer stopped heartbeating for a whole visibility timeout
+        response = await self.redis.xautoclaim(
+            self.stream(shard),
+            self.group,
+            consumer,
+            min_idle_time=int(self.visibility_timeout * 1000),
+            start_id="0-0",
+            count=count,
+        )
+        jobs = []
+        for entry_id, fields in response[1]:
+            if not fields:
+                # Trimmed from the stream while pending
+                await self.redis.xack(self.stream(shard), self.group, entry_id)
+                continue
+            job = Job.from_entry(shard, entry_id, fields)
+            pending = await self.redis.xpending_range(
+                self.stream(shard), self.group, min=job.id, max=job.id, count=1
+            )
+            job.attempt = pending[0]["times_delivered"] if pending else 1
+            jobs.append(job)
+        return jobs
+
+    async def heartbeat(self, job: Job, consumer: str):
+        await self.redis.xclaim(
+            self.stream(job.shard), self.group, consumer, min_idle_time=0, message_ids=[job.id], justid=True
+        )
+
+    async def ack(self, job: Job):
+        await self.redis.xack(self.stream(job.shard), self.group, job.id)
+
+    async def dead_letter(self, job: Job, error: Exception):
+        await self.redis.xadd(
+            self.dead_stream,
+            {
+                "job_id": job.id,
+                "kind": job.kind,
+                "user_id": job.user_id,
+                "payload": json.dumps(job.payload, ensure_ascii=False),
+                "attempts": job.attempt,
+                "error": str(error)[:1000],
+            },
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+        await self.ack(job)
+
+
+class JobWorker:
+    def __init__(self, queue: JobQueue, handlers: dict, on_dead=None, concurrency: int = 8,
+                 max_shards: int | None = None, retry_delay: float = 2.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.on_dead = on_dead
+        self.concurrency = concurrency
+        # Without a fixed limit the shards are split evenly over the live workers
+        self.max_shards = max_shards
+        self.shard_limit = max_shards or queue.shards
+        self.retry_delay = retry_delay
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.owned: set[int] = set()
+        self.active: set[asyncio.Task] = set()
+        self.tails: dict[int, asyncio.Task] = {}
+        # Job id -> shard of every job started and not finished yet
+        self.running: dict[str, int] = {}
+        self.stopping = asyncio.Event()
+
+    async def run(self):
+        logger.info(f"Job worker {self.consumer} started")
+        leases = asyncio.create_task(self._maintain_leases())
+        try:
+            while not self.stopping.is_set():
+                free = self.concurrency - len(self.active)
+                if not self.owned or free <= 0:
+                    await self._wait_for_capacity()
+                    continue
+                try:
+                    jobs = await self.queue.read(sorted(self.owned), self.consumer, count=free)
+                except Exception as e:
+                    logger.error(f"Error reading jobs: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for job in jobs:
+                    self._start(job)
+        finally:
+            leases.cancel()
+            await self._drain()
+
+    def stop(self):
+        self.stopping.set()
+
+    async def _wait_for_capacity(self):
+        if self.active:
+            await asyncio.wait(set(self.active), timeout=1, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await asyncio.sleep(1)
+
+    def _start(self, job: Job):
+        if job.id in self.running:
+            # Reclaimed while still waiting here, e.g. behind a long job of the same user
+            return
+        # Chain each job behind the previous one of the same user to keep their order
+        previous = self.tails.get(job.user_id)
+        self.running[job.id] = job.shard
+        task = asyncio.create_task(self._process(job, previous))
+        self.tails[job.user_id] = task
+        self.active.add(task)
+        task.add_done_callback(lambda t: self._finished(job, t))
+
+    def _finished(self, job: Job, task: asyncio.Task):
+        self.active.discard(task)
+        self.running.pop(job.id, None)
+        if self.tails.get(job.user_id) is task:
+            del self.tails[job.user_id]
+
+    async def _process(self, job: Job, previous: asyncio.Task | None):
+        # Heartbeat from the moment the job is read, so waiting behind a predecessor doesn't look idle
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            if previous is not None:
+                await asyncio.wait({previous})
+            await self._handle(job)
+        except Exception as e:
+            # Leaving the entry unacked lets another consumer reclaim it after the visibility timeout
+            logger.error(f"Error finishing job {job.id}: {e}")
+        finally:
+            heartbeat.cancel()
+
+    async def _handle(self, job: Job):
+        JOB_QUEUE_WAIT.labels(job.kind).observe(max(time.time() - job.enqueued_at, 0))
+        if job.attempt > self.queue.max_attempts:
+            # Redelivered after crashing its consumer too many times
+            logger.error(f"Job {job.id} ({job.kind}) exceeded {self.queue.max_attempts} deliveries")
+            await self._dead(job, RuntimeError("Too many deliveries"))
+            return
+        handler = self.handlers.get(job.kind)
+        if handler is None:
+            logger.error(f"No handler for job kind {job.kind}, dropping job {job.id}")
+            await self.queue.dead_letter(job, ValueError(f"Unknown job kind {job.kind}"))
+            return
+
+        while True:
+            try:
+                await handler(job)
+                await self.queue.ack(job)
+                JOBS.labels(job.kind, "done").inc()
+                return
+            except Exception as e:
+                if job.attempt >= self.queue.max_attempts:
+                    logger.error(f"Job {job.id} ({job.kind}) failed after {job.attempt} attempts: {e}")
+                    await self._dead(job, e)
+                    return
+                delay = random.uniform(0, self.retry_delay * 2 ** (job.attempt - 1))
+                logger.warning(f"Job {job.id} ({job.kind}) failed: {e}, retry {job.attempt} in {delay:.2f}s")
+                JOBS.labels(job.kind, "retried").inc()
+                job.attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _dead(self, job: Job, error: Exception):
+        JOBS.labels(job.kind, "dead").inc()
+        await self.queue.dead_letter(job, error)
+        if self.on_dead is not None:
+            await self.on_dead(job, error)
+
+    async def _heartbeat(self, job: Job):
+        while True:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            try:
+                await self.queue.heartbeat(job, self.consumer)
+            except Exception as e:
+                logger.warning(f"Could not extend visibility of job {job.id}: {e}")
+
+    async def _maintain_leases(self):
+        # Start from a random shard so workers on different nodes spread over the shards
+        offset = random.randrange(self.queue.shards)
+        order = [(offset + i) % self.queue.shards for i in range(self.queue.shards)]
+        while True:
+            try:
+                live = await self.queue.register_worker(self.consumer)
+                # A crashed worker drops out of the count, so the others take over its shards
+                self.shard_limit = self.max_shards or math.ceil(self.queue.shards / max(live, 1))
+                await self._release_surplus()
+            except Exception as e:
+                logger.error(f"Error registering worker {self.consumer}: {e}")
+            for shard in order:
+                if shard not in self.owned and len(self.owned) >= self.shard_limit:
+                    continue
+                try:
+                    if await self.queue.acquire_lease(shard, self.consumer):
+                        if shard not in self.owned:
+                            await self.queue.ensure_group(shard)
+                            self.owned.add(shard)
+                            logger.info(f"Worker {self.consumer} took shard {shard}")
+                        for job in await self.queue.reclaim(shard, self.consumer, count=self.concurrency):
+                            logger.warning(f"Reclaimed job {job.id} ({job.kind}), delivery {job.attempt}")
+                            self._start(job)
+                    elif shard in self.owned:
+                        self.owned.discard(shard)
+                        logger.warning(f"Worker {self.consumer} lost shard {shard}")
+                except Exception as e:
+                    logger.error(f"Error maintaining lease for shard {shard}: {e}")
+            await asyncio.sleep(self.queue.lease_ttl / 3)
+
+    async def _release_surplus(self):
+        # Hand idle shards back when more workers joined; busy ones are kept to preserve per-user order
+        busy = set(self.running.values())
+        surplus = len(self.owned) - self.shard_limit
+        for shard in sorted(self.owned - busy)[:max(surplus, 0)]:
+            self.owned.discard(shard)
+            await self.queue.release_lease(shard, self.consumer)
+            logger.info(f"Worker {self.consumer} released shard {shard}")
+
+    async def _drain(self):
+        if self.active:
+            logger.info(f"Waiting for {len(self.active)} jobs to finish")
+            await asyncio.wait(set(self.active), timeout=self.queue.visibility_timeout)
+        for shard in list(self.owned):
+            try:
+                await self.queue.release_lease(shard, self.consumer)
+            except Exception as e:
+                logger.warning(f"Could not release shard {shard}: {e}")
+        self.owned.clear()
+        try:
+            await self.queue.unregister_worker(self.consumer)
+        except Exception as e:
+            logger.warning(f"Could not unregister worker {self.consumer}: {e}")
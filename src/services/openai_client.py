@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from contextlib import nullcontext
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+from redis.asyncio import Redis
+
+from src.services.scheduler import Scheduler
+from src.utils.logger import OPENAI_REQUESTS, record_usage
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# Returns how many milliseconds the caller has to wait; 0 means a token was taken.
+TOKEN_BUCKET_SCRIPT = """
+local pause = redis.call('PTTL', KEYS[2])
+if pause > 0 then
+    return pause
+end
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate) * 2)
+return wait
+"""
+
+
+def parse_duration(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class LocalTokenBucket:
+    def __init__(self, capacity: float, rate_per_second: float):
+        self.capacity = capacity
+        self.rate = rate_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def take(self) -> float:
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: dict[str, int], redis: Redis | None = None):
+        self.requests_per_minute = requests_per_minute
+        self.redis = redis
+        self.local = {
+            endpoint: LocalTokenBucket(rpm, rpm / 60)
+            for endpoint, rpm in requests_per_minute.items()
+        }
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT) if redis is not None else None
+
+    async def acquire(self, endpoint: str, deadline: float):
+        rpm = self.requests_per_minute.get(endpoint)
+        if not rpm:
+            return
+        while True:
+            wait = await self._take(endpoint, rpm)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise TimeoutError(f"Rate limit for {endpoint} would exceed the request deadline")
+            await asyncio.sleep(wait)
+
+    async def _take(self, endpoint: str, rpm: int) -> float:
+        if self._script is not None:
+            try:
+                wait_ms = await self._script(
+                    keys=[f"ratelimit:bucket:{endpoint}", f"ratelimit:pause:{endpoint}"],
+                    args=[rpm, rpm / 60000],
+                )
+                return int(wait_ms) / 1000
+            except Exception as e:
+                logger.warning(f"Shared rate limiter unavailable, using local bucket: {e}")
+        return self.local[endpoint].take()
+
+    async def observe(self, endpoint: str, headers):
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None or int(float(remaining)) > 0:
+                continue
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}")) or 1.0
+            await self.pause(endpoint, reset)
+
+    async def pause(self, endpoint: str, seconds: float):
+        logger.warning(f"Pausing {endpoint} requests for {seconds:.2f}s")
+        if endpoint in self.local:
+            self.local[endpoint].paused_until = max(self.local[endpoint].paused_until, time.monotonic() + seconds)
+        if self.redis is not None:
+            try:
+                await self.redis.set(f"ratelimit:pause:{endpoint}", 1, px=max(int(seconds * 1000), 1))
+            except Exception as e:
+                logger.warning(f"Could not share rate limit pause for {endpoint}: {e}")
+
+
+class ResilientOpenAI:
+    def __init__(self, limiter: RateLimiter, scheduler: Scheduler | None = None, deadline: float = 60.0,
+                 base_delay: float = 0.5, max_delay: float = 20.0, hedge_delay: float = 2.0):
+        self.limiter = limiter
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_delay = hedge_delay
+
+    async def call(self, endpoint: str, fn, *args, idempotent: bool = True, hedge: bool = False,
+                   deadline: float | None = None, **kwargs):
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await self.limiter.acquire(endpoint, deadline_at)
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Deadline exceeded for {endpoint} request")
+                limit = self.scheduler.limit(endpoint) if self.scheduler is not None else nullcontext()
+                async with limit:
+                    if hedge:
+                        response = await asyncio.wait_for(self._hedged(fn, args, kwargs), remaining)
+                    else:
+                        response = await asyncio.wait_for(fn(*args, **kwargs), remaining)
+                result = await self._unwrap(endpoint, response)
+                OPENAI_REQUESTS.labels(endpoint, "ok").inc()
+                record_usage(endpoint, result)
+                return result
+            except (RateLimitError, APIStatusError, APIConnectionError, APITimeoutError) as e:
+                status = str(e.status_code) if isinstance(e, APIStatusError) else e.__class__.__name__
+                OPENAI_REQUESTS.labels(endpoint, status).inc()
+                delay = await self._retry_delay(endpoint, e, attempt, idempotent)
+                if delay is None or time.monotonic() + delay > deadline_at:
+                    raise
+                logger.warning(f"{endpoint} request failed ({e.__class__.__name__}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def _unwrap(self, endpoint: str, response):
+        # with_raw_response calls give us the rate limit headers before parsing
+        if hasattr(response, "headers") and hasattr(response, "parse"):
+            await self.limiter.observe(endpoint, response.headers)
+            return response.parse()
+        return response
+
+    async def _retry_delay(self, endpoint: str, error: Exception, attempt: int, idempotent: bool) -> float | None:
+        retry_after = None
+        if isinstance(error, APIStatusError):
+            if error.status_code not in RETRYABLE_STATUSES:
+                return None
+            headers = error.response.headers
+            await self.limiter.observe(endpoint, headers)
+            retry_after = parse_duration(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000 if retry_after is not None else parse_duration(headers.get("retry-after"))
+            if isinstance(error, RateLimitError) and retry_after:
+                await self.limiter.pause(endpoint, retry_after)
+        # A rejected 429 never reached the model, anything else may have had side effects
+        if not idempotent and not isinstance(error, RateLimitError):
+            return None
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(backoff, retry_after or 0)
+
+    async def _hedged(self, fn, args, kwargs):
+        tasks = {asyncio.create_task(fn(*args, **kwargs))}
+        try:
+            # Also covers being cancelled by the caller's deadline during the hedge delay
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if done:
+                return done.pop().result()
+            tasks.add(asyncio.create_task(fn(*args, **kwargs)))
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    if not tasks:
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -1,25 +1,103 @@
-import aiofiles
-from uuid import uuid4
+import asyncio
+import hashlib
 import logging
-
-from aiogram.fsm.context import FSMContext
-from openai import AsyncOpenAI
-from src.database.services import save_value
+import time
+from pathlib import Path
+
+from openai import AsyncOpenAI, BadRequestError, NotFoundError
+from src.database.services import get_user_values, save_value
+from src.services.cache import DiskCache, TwoTierCache
+from src.services.openai_client import RateLimiter, ResilientOpenAI
+from src.services.scheduler import Scheduler
+from src.services.thread_registry import ThreadRegistry
+from src.utils.images import MOOD_UNDETECTED
+from src.utils.logger import track_stage
+from src.utils.text import SentenceSplitter, normalize_value
 import json
-from amplitude import Amplitude, BaseEvent
-from concurrent.futures import ThreadPoolExecutor
+from src.services.analytics import AnalyticsClient
 
 logger = logging.getLogger(__name__)
-amplitude_executor = ThreadPoolExecutor(max_workers=1)
+NO_RESPONSE = "Sorry, I couldn't generate a response."
+REQUEST_FAILED = "Sorry, I couldn't process your request."
+UNEXPECTED_STATUS = "Sorry, something went wrong."
+PROCESSING_ERROR = "An error occurred while processing your request."
+FALLBACK_ANSWERS = (NO_RESPONSE, REQUEST_FAILED, UNEXPECTED_STATUS, PROCESSING_ERROR)
+TERMINAL_RUN_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete")
+RUN_CANCEL_TIMEOUT = 15.0
+
+RUN_INSTRUCTIONS = """
+    Ты — помощник, который помогает человеку определить его ключевые жизненные ценности.
+    Если человек говорит фразу, которая может быть ценностью, используй инструмент validate_value, чтобы проверить её.
+    Подтверждённая ценность сохраняется автоматически, отдельно сохранять её не нужно.
+    Если фраза не является ценностью, просто продолжай диалог.
+    Не спрашивай пользователя о технических деталях проверки — просто решай сам, когда звать функции.
+    При поиске информации в документах, всегда указывай название файла после цитаты.
+"""
+
+RUN_TOOLS = [
+    {
+        "type": "file_search"
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "validate_value",
+            "description": "Проверяет, является ли данное значение ключевой ценностью.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "value": {"type": "string", "description": "Текст для проверки на ценность."}
+                },
+                "required": ["value"]
+            }
+        }
+    }
+]
 
 
 class OpenAIBot:
-    def __init__(self, api_key: str, assistant_id: str = None, amplitude_key: str = None):
-        self.client = AsyncOpenAI(api_key=api_key)
-        self.user_threads = {}
+    def __init__(self, api_key: str, assistant_id: str = None, analytics: AnalyticsClient = None,
+                 tool_concurrency: int = 4, redis=None, validation_cache_size: int = 2048,
+                 validation_cache_ttl: int = 7 * 24 * 3600, vision_detail: str = "auto",
+                 scheduler: Scheduler = None, rate_limiter: RateLimiter = None, request_deadline: float = 60.0,
+                 hedge_delay: float = 2.0, run_poll_interval: float = 0.5, run_timeout: float = 120.0,
+                 threads: ThreadRegistry = None, compact_after_turns: int = 20, compact_history_messages: int = 40,
+                 compaction_model: str = "gpt-4o-mini", run_truncation_messages: int = 0, base_url: str = None,
+                 tts_model: str = "tts-1", tts_voice: str = "alloy", tts_format: str = "opus",
+                 audio_cache: DiskCache = None):
+        # Retries are handled by ResilientOpenAI so they respect our shared buckets and deadlines
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.scheduler = scheduler or Scheduler(limits={})
+        self.api = ResilientOpenAI(
+            rate_limiter or RateLimiter(requests_per_minute={}),
+            scheduler=self.scheduler,
+            deadline=request_deadline,
+            hedge_delay=hedge_delay,
+        )
+        self.run_poll_interval = run_poll_interval
+        self.run_timeout = run_timeout
+        self.validation_cache = TwoTierCache(
+            redis, "validate_value", max_size=validation_cache_size, ttl=validation_cache_ttl
+        )
+        self.tool_semaphore = asyncio.Semaphore(tool_concurrency)
+        self.threads = threads or ThreadRegistry(redis=None)
+        self.compact_after_turns = compact_after_turns
+        self.compact_history_messages = compact_history_messages
+        self.compaction_model = compaction_model
+        self.compactions: dict[int, asyncio.Task] = {}
+        if run_truncation_messages > 0:
+            self.truncation_strategy = {"type": "last_messages", "last_messages": run_truncation_messages}
+        else:
+            self.truncation_strategy = {"type": "auto"}
         self.assistant_id = assistant_id
-        self.amplitude_client = Amplitude(api_key=amplitude_key)
+        self.vision_detail = vision_detail
+        self.tts_model = tts_model
+        self.tts_voice = tts_voice
+        self.tts_format = tts_format
+        self.audio_cache = audio_cache
+        self.analytics = analytics or AnalyticsClient(api_key=None)
         self.vector_store_id = None
+        self.file_names: dict[str, str] = {}
         logger.info("OpenAIBot initialized with API key")
         logger.info(f"Assistant ID: {self.assistant_id}")
 
@@ -29,9 +107,10 @@ class OpenAIBot:
                 name=name
             )
             self.vector_store_id = vector_store.id
+            content = await asyncio.to_thread(Path(file_path).read_bytes)
             file = await self.client.beta.vector_stores.files.upload_and_poll(
                 vector_store_id=vector_store.id,
-                file=open(file_path, "rb")
+                file=(Path(file_path).name, content)
             )
 
             logger.info(f"Created vector store {vector_store.id} with file {file.id}")
@@ -40,6 +119,98 @@ class OpenAIBot:
             logger.error(f"Error creating vector store: {e}", exc_info=True)
             raise
 
+    async def sync_vector_store(self, directory: str, manifest_path: str, name: str = "Values Documents",
+                                concurrency: int = 8, batch_size: int = 100) -> dict:
+        manifest_file = Path(manifest_path)
+        if manifest_file.exists():
+            manifest = json.loads(await asyncio.to_thread(manifest_file.read_text, encoding="utf-8"))
+        else:
+            manifest = {"vector_store_id": None, "files": {}}
+
+        vector_store_id = manifest["vector_store_id"] or self.vector_store_id
+        if vector_store_id:
+            try:
+                await self.client.beta.vector_stores.retrieve(vector_store_id)
+            except NotFoundError:
+                logger.warning(f"Vector store {vector_store_id} is gone, creating a new one")
+                vector_store_id = None
+                manifest["files"] = {}
+        if not vector_store_id:
+            vector_store = await self.client.beta.vector_stores.create(name=name)
+            vector_store_id = vector_store.id
+            logger.info(f"Created vector store {vector_store_id}")
+        manifest["vector_store_id"] = vector_store_id
+        self.vector_store_id = vector_store_id
+
+        root = Path(directory)
+        paths = [path for path in sorted(root.rglob("*")) if path.is_file() and not path.name.startswith(".")]
+        contents = await asyncio.gather(*(asyncio.to_thread(path.read_bytes) for path in paths))
+        documents = {
+            path.relative_to(root).as_posix(): (content, hashlib.sha256(content).hexdigest())
+            for path, content in zip(paths, contents)
+        }
+
+        known = manifest["files"]
+        changed = [key for key, (_, digest) in documents.items() if known.get(key, {}).get("sha256") != digest]
+        stale_ids = [known[key]["file_id"] for key in known if key not in documents or key in changed]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(key: str) -> str:
+            content, _ = documents[key]
+            async with semaphore:
+                file = await self.client.files.create(file=(Path(key).name, content), purpose="assistants")
+            self.file_names[file.id] = file.filename
+            return file.id
+
+        uploaded = dict(zip(changed, await asyncio.gather(*(upload(key) for key in changed))))
+        file_ids = list(uploaded.values())
+        failed_ids = set()
+        for start in range(0, len(file_ids), batch_size):
+            batch = await self.client.beta.vector_stores.file_batches.create_and_poll(
+                vector_store_id=vector_store_id,
+                file_ids=file_ids[start:start + batch_size],
+            )
+            logger.info(f"File batch {batch.id}: {batch.file_counts.completed} completed, "
+                        f"{batch.file_counts.failed} failed")
+            if batch.file_counts.completed < batch.file_counts.total:
+                async for file in self.client.beta.vector_stores.file_batches.list_files(
+                    batch.id, vector_store_id=vector_store_id
+                ):
+                    if file.status != "completed":
+                        failed_ids.add(file.id)
+
+        async def remove(file_id: str):
+            async with semaphore:
+                try:
+                    await self.client.beta.vector_stores.files.delete(file_id, vector_store_id=vector_store_id)
+                    await self.client.files.delete(file_id)
+                except NotFoundError:
+                    pass
+            self.file_names.pop(file_id, None)
+
+        await asyncio.gather(*(remove(file_id) for file_id in stale_ids))
+
+        manifest["files"] = {
+            key: {"sha256": digest, "file_id": uploaded.get(key) or known[key]["file_id"]}
+            for key, (_, digest) in documents.items()
+        }
+        for key, file_id in uploaded.items():
+            if file_id in failed_ids:
+                # No digest makes the next sync remove this copy and upload the file again
+                logger.warning(f"Indexing failed for {key}, it will be retried on the next sync")
+                manifest["files"][key]["sha256"] = None
+        await asyncio.to_thread(
+            manifest_file.write_text, json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        summary = {
+            "uploaded": len(uploaded) - len(failed_ids),
+            "failed": len(failed_ids),
+            "removed": len(stale_ids),
+            "unchanged": len(documents) - len(uploaded),
+        }
+        logger.info(f"Synced vector store {vector_store_id}: {summary}")
+        return summary
+
     async def update_assistant_with_file_search(self):
         if not self.assistant_id:
             raise ValueError("Assistant ID is not set")
@@ -66,17 +237,39 @@ class OpenAIBot:
             logger.error(f"Error updating assistant: {e}", exc_info=True)
             raise
 
+    async def _file_name(self, file_id: str) -> str:
+        file_name = self.file_names.get(file_id)
+        if file_name is None:
+            file_info = await self.api.call(
+                "files", self.client.files.with_raw_response.retrieve, file_id, hedge=True
+            )
+            file_name = self.file_names[file_id] = file_info.filename
+        return file_name
+
+    async def warm_file_cache(self):
+        try:
+            vector_store_ids = [self.vector_store_id] if self.vector_store_id else []
+            if not vector_store_ids and self.assistant_id:
+                assistant = await self.client.beta.assistants.retrieve(self.assistant_id)
+                file_search = assistant.tool_resources and assistant.tool_resources.file_search
+                vector_store_ids = list(file_search.vector_store_ids) if file_search else []
+
+            file_ids = []
+            for vector_store_id in vector_store_ids:
+                async for file in self.client.beta.vector_stores.files.list(vector_store_id=vector_store_id):
+                    file_ids.append(file.id)
+            await asyncio.gather(*(self._file_name(file_id) for file_id in file_ids))
+            logger.info(f"Cached names of {len(self.file_names)} vector store files")
+        except Exception as e:
+            logger.error(f"Error warming file cache: {e}", exc_info=True)
+
+    @track_stage("analyze_mood")
     async def analyze_mood_from_photo(self, image_url: str, user_id: int):
         try:
-            amplitude_executor.submit(
-                self.amplitude_client.track,
-                BaseEvent(
-                    event_type="photo_uploaded",
-                    user_id=str(user_id),
-                    event_properties={"image_url": image_url},
-                ),
-            )
-            response = await self.client.chat.completions.create(
+            self.analytics.track("photo_uploaded", user_id, {"image_size": len(image_url) * 3 // 4})
+            response = await self.api.call(
+                "vision",
+                self.client.chat.completions.with_raw_response.create,
                 model="gpt-4o",
                 messages=[
                     {
@@ -84,7 +277,8 @@ class OpenAIBot:
                         "content": [
                             {"type": "text",
                              "text": "Определи настроение человека на фото. Ответь одним словом: счастье, грусть, злость, нейтрально, удивление.Если не получится определить настроение верни сообщение Не удалось определить настроение."},
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_url}", }},
+                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_url}",
+                                                               "detail": self.vision_detail}},
                         ],
                     }
                 ],
@@ -92,43 +286,38 @@ class OpenAIBot:
             )
             mood = response.choices[0].message.content
             logger.info(f"Mood analysis result for user {user_id}: {mood}")
-            amplitude_executor.submit(
-                self.amplitude_client.track,
-                BaseEvent(
-                    event_type="photo_analyzed",
-                    user_id=str(user_id),
-                    event_properties={"mood": mood},
-                ),
-            )
+            self.analytics.track("photo_analyzed", user_id, {"mood": mood})
 
             return mood
         except Exception as e:
             logger.error(f"Error in analyze_mood_from_photo: {e}", exc_info=True)
-            amplitude_executor.submit(
-                self.amplitude_client.track,
-                BaseEvent(
-                    event_type="photo_analysis_failed",
-                    user_id=str(user_id),
-                    event_properties={"error": str(e)},
-                ),
-            )
-            return "Не удалось определить настроение."
+            self.analytics.track("photo_analysis_failed", user_id, {"error": str(e)})
+            return MOOD_UNDETECTED
 
-    async def voice_to_text(self, audio_file_path):
+    @track_stage("voice_to_text")
+    async def voice_to_text(self, audio: bytes):
         try:
-            async with aiofiles.open(audio_file_path, "rb") as audio_file:
-                content = await audio_file.read()
-                transcript = await self.client.audio.transcriptions.create(
-                    file=("voice_message.ogg", content, "audio/ogg"),
-                    model="whisper-1",
-                )
-                logger.info("Voice message successfully transcribed")
+            transcript = await self.api.call(
+                "stt",
+                self.client.audio.transcriptions.with_raw_response.create,
+                file=("voice_message.ogg", audio, "audio/ogg"),
+                model="whisper-1",
+            )
+            logger.info("Voice message successfully transcribed")
             return transcript.text
         except Exception as e:
             logger.error(f"Error in transcribing audio: {e}")
             raise
 
+    @track_stage("validate_value")
     async def validate_value(self, value: str) -> dict:
+        cache_key = normalize_value(value)
+        if cache_key:
+            cached = await self.validation_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"[validate_value] Cache hit for '{cache_key}'")
+                return cached
+
         try:
             json_schema = {
                 "name": "value_validation",
@@ -143,7 +332,9 @@ class OpenAIBot:
                     "additionalProperties": False
                 }
             }
-            response = await self.client.chat.completions.create(
+            response = await self.api.call(
+                "chat",
+                self.client.chat.completions.with_raw_response.create,
                 model="gpt-4o-2024-08-06",
                 messages=[
                     {
@@ -169,6 +360,8 @@ class OpenAIBot:
                 content = response.choices[0].message.content
                 try:
                     validation_result = json.loads(content)
+                    if cache_key:
+                        await self.validation_cache.set(cache_key, validation_result)
                 except json.JSONDecodeError:
                     logger.error(f"[validate_value] Error in decoding JSON: {content}")
                     validation_result = {"is_valid": False, "value_type": None}
@@ -182,165 +375,401 @@ class OpenAIBot:
             logger.error(f"Error in validate_value: {e}", exc_info=True)
             return {"is_valid": False, "value_type": None}
 
-    async def get_answer(self, user_id: int, prompt: str, state: FSMContext):
-        try:
-            data = await state.get_data()
-            thread_id = data.get('thread_id')
-
-            if not thread_id:
-                thread = await self.client.beta.threads.create()
-                thread_id = thread.id
-                await state.update_data(thread_id=thread_id)
-                logger.info(f"Created new thread for user {user_id}: {thread_id}")
-            else:
-                logger.info(f"Using existing thread for user {user_id}: {thread_id}")
+    async def _create_thread(self, user_id: int) -> str:
+        thread = await self.api.call(
+            "threads", self.client.beta.threads.with_raw_response.create, idempotent=False
+        )
+        await self.threads.set(user_id, thread.id)
+        logger.info(f"Created new thread for user {user_id}: {thread.id}")
+        return thread.id
+
+    async def _add_message(self, thread_id: str, prompt: str):
+        await self.api.call(
+            "threads",
+            self.client.beta.threads.messages.with_raw_response.create,
+            thread_id=thread_id,
+            role="user",
+            content=prompt,
+            idempotent=False,
+        )
+
+    @track_stage("prepare_thread")
+    async def _prepare_thread(self, user_id: int, prompt: str) -> str:
+        if not self.assistant_id:
+            raise Exception("Assistant ID is not set. Please create the assistant first.")
 
-            await self.client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=prompt,
-            )
-            logger.info(f"Message added to thread for user {user_id}")
+        compaction = self.compactions.get(user_id)
+        if compaction is not None:
+            await asyncio.wait({compaction})
+        else:
+            # Another process may be rotating this user's thread
+            await self.threads.wait_for_compaction(user_id)
 
-            if not self.assistant_id:
-                raise Exception("Assistant ID is not set. Please create the assistant first.")
+        thread_id = await self.threads.get(user_id)
+        if not thread_id:
+            thread_id = await self._create_thread(user_id)
+        else:
+            logger.info(f"Using existing thread for user {user_id}: {thread_id}")
 
-            response = await self.client.beta.threads.runs.create_and_poll(
-                thread_id=self.user_threads[user_id],
-                assistant_id=self.assistant_id,
-                instructions="""
-                    Ты — помощник, который помогает человеку определить его ключевые жизненные ценности.
-                    Если человек говорит фразу, которая может быть ценностью, используй инструмент validate_value, чтобы проверить её.
-                    Если validate_value подтверждает, что это ценность, используй инструмент save_value для сохранения её в базу.
-                    Если фраза не является ценностью, продолжай диалог без вызова save_value.
-                    Не спрашивай пользователя о технических деталях проверки — просто решай сам, когда звать функции.
-                    При поиске информации в документах, всегда указывай название файла после цитаты.
-                """,
-                tools=[
-                    {
-                        "type": "file_search"
-                    },
+        try:
+            await self._add_message(thread_id, prompt)
+        except NotFoundError:
+            logger.warning(f"Thread {thread_id} of user {user_id} no longer exists, starting a new one")
+            thread_id = await self._create_thread(user_id)
+            await self._add_message(thread_id, prompt)
+        logger.info(f"Message added to thread for user {user_id}")
+        return thread_id
+
+    async def _finish_turn(self, user_id: int, thread_id: str):
+        turns = await self.threads.increment_turns(user_id)
+        if (self.compact_after_turns and turns >= self.compact_after_turns and user_id not in self.compactions
+                and await self.threads.start_compaction(user_id)):
+            # Marked while this turn still holds the user slot, so the next turn sees it in any process
+            task = asyncio.create_task(self._compact_thread(user_id, thread_id))
+            self.compactions[user_id] = task
+            task.add_done_callback(lambda _: self.compactions.pop(user_id, None))
+
+    async def _compact_thread(self, user_id: int, thread_id: str):
+        try:
+            # The first message of a compacted thread is the previous memory, which the recent window misses
+            first, recent = await asyncio.gather(
+                self.api.call(
+                    "threads",
+                    self.client.beta.threads.messages.with_raw_response.list,
+                    thread_id=thread_id,
+                    order="asc",
+                    limit=1,
+                    hedge=True,
+                ),
+                self.api.call(
+                    "threads",
+                    self.client.beta.threads.messages.with_raw_response.list,
+                    thread_id=thread_id,
+                    order="desc",
+                    limit=self.compact_history_messages,
+                    hedge=True,
+                ),
+            )
+            history = list(reversed(recent.data))
+            if first.data and all(message.id != first.data[0].id for message in history):
+                history.insert(0, first.data[0])
+            turns = []
+            for message in history:
+                text = " ".join(part.text.value for part in message.content if hasattr(part, "text"))
+                if text:
+                    turns.append(f"{message.role}: {text}")
+            values = await get_user_values(user_id, limit=20)
+
+            response = await self.api.call(
+                "chat",
+                self.client.chat.completions.with_raw_response.create,
+                model=self.compaction_model,
+                messages=[
                     {
-                        "type": "function",
-                        "function": {
-                            "name": "validate_value",
-                            "description": "Проверяет, является ли данное значение ключевой ценностью.",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "value": {"type": "string", "description": "Текст для проверки на ценность."}
-                                },
-                                "required": ["value"]
-                            }
-                        }
+                        "role": "system",
+                        "content": (
+                            "Сожми переписку пользователя с помощником в краткую память на русском языке: "
+                            "что обсуждали, какие ценности пользователь назвал, что осталось незавершённым. "
+                            "Не больше 10 предложений."
+                        )
                     },
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "save_value",
-                            "description": "Сохраняет подтверждённую ценность пользователя.",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "user_id": {"type": "integer", "description": "ID пользователя."},
-                                    "value": {"type": "string", "description": "Подтверждённая ключевая ценность."}
-                                },
-                                "required": ["user_id", "value"]
-                            }
-                        }
-                    }
+                    {"role": "user", "content": "\n".join(turns)}
                 ],
+            )
+            summary = response.choices[0].message.content
+            memory = f"Краткая память о предыдущем разговоре: {summary}"
+            if values:
+                memory += "\nСохранённые ценности пользователя: " + ", ".join(value for value, _ in values)
+
+            thread = await self.api.call(
+                "threads",
+                self.client.beta.threads.with_raw_response.create,
+                messages=[{"role": "assistant", "content": memory}],
+                idempotent=False,
+            )
+            if await self.threads.get(user_id) != thread_id:
+                logger.warning(f"Thread of user {user_id} changed during compaction, keeping the current one")
+                return
+            await self.threads.set(user_id, thread.id)
+            logger.info(f"Compacted thread {thread_id} of user {user_id} into {thread.id}")
+        except Exception as e:
+            logger.error(f"Error compacting thread for user {user_id}: {e}", exc_info=True)
+        finally:
+            await self.threads.finish_compaction(user_id)
+
+    @track_stage("run_poll")
+    async def _wait_for_run(self, thread_id: str, run):
+        deadline = time.monotonic() + self.run_timeout
+        while run.status in ["queued", "in_progress", "cancelling"]:
+            if time.monotonic() > deadline:
+                logger.warning(f"Run {run.id} did not finish in {self.run_timeout}s, cancelling it")
+                return await self._cancel_run(thread_id, run.id) or run
+            await asyncio.sleep(self.run_poll_interval)
+            run = await self.api.call(
+                "threads",
+                self.client.beta.threads.runs.with_raw_response.retrieve,
+                thread_id=thread_id,
+                run_id=run.id,
+                hedge=True,
+            )
+        return run
 
-                tool_choice="auto"
+    async def _cancel_run(self, thread_id: str, run_id: str):
+        # An active run blocks new messages on the thread until the API expires it minutes later
+        try:
+            run = await self.api.call(
+                "threads",
+                self.client.beta.threads.runs.with_raw_response.cancel,
+                thread_id=thread_id,
+                run_id=run_id,
             )
-            logger.info(f"Run started for user {user_id}: {response.id}")
+            deadline = time.monotonic() + RUN_CANCEL_TIMEOUT
+            while run.status not in TERMINAL_RUN_STATUSES and time.monotonic() < deadline:
+                await asyncio.sleep(self.run_poll_interval)
+                run = await self.api.call(
+                    "threads",
+                    self.client.beta.threads.runs.with_raw_response.retrieve,
+                    thread_id=thread_id,
+                    run_id=run_id,
+                )
+            logger.info(f"Run {run_id} ended with status {run.status}")
+            return run
+        except BadRequestError as e:
+            # Already finished between our last poll and the cancel
+            logger.info(f"Run {run_id} could not be cancelled: {e}")
+        except Exception as e:
+            logger.error(f"Error cancelling run {run_id}: {e}")
+        return None
+
+    async def _run_tool_call(self, user_id: int, tool_call) -> dict:
+        async with self.tool_semaphore:
+            function_name = tool_call.function.name
+            try:
+                function_args = json.loads(tool_call.function.arguments)
+
+                if function_name == "validate_value":
+                    validation_result = await self.validate_value(function_args["value"])
+                    if validation_result["is_valid"]:
+                        await save_value(user_id=user_id, value=validation_result["value_type"])
+                        logger.info(f"Value saved for user {user_id}: {validation_result['value_type']}")
+                    output = validation_result
+
+                elif function_name == "save_value":
+                    # Left for runs started with the old tool list; the user id never comes from the model
+                    await save_value(user_id=user_id, value=function_args["value"])
+                    output = {"status": "success"}
+
+                else:
+                    logger.warning(f"Unknown tool requested: {function_name}")
+                    output = {"error": f"Unknown function {function_name}"}
+            except Exception as e:
+                logger.error(f"Error in tool call {function_name}: {e}", exc_info=True)
+                output = {"error": str(e)}
+
+            return {
+                "tool_call_id": tool_call.id,
+                "output": json.dumps(output),
+            }
 
-            if response.status == "requires_action":
-                tool_calls = response.required_action.submit_tool_outputs.tool_calls
-                tool_outputs = []
-
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-
-                    if function_name == "validate_value":
-                        validation_result = await self.validate_value(function_args["value"])
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps(validation_result),
-                        })
-                        if validation_result["is_valid"]:
-                            await save_value(user_id=user_id, value=validation_result["value_type"])
-                            logger.info(f"Value saved for user {user_id}: {validation_result['value_type']}")
-
-                    elif function_name == "save_value":
-                        await save_value(user_id=function_args["user_id"], value=function_args["value"])
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps({"status": "success"}),
-                        })
-
-                await self.client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=self.user_threads[user_id],
-                    run_id=response.id,
-                    tool_outputs=tool_outputs
+    @track_stage("tool_calls")
+    async def _handle_tool_calls(self, user_id: int, tool_calls) -> list[dict]:
+        return list(await asyncio.gather(
+            *(self._run_tool_call(user_id, tool_call) for tool_call in tool_calls)
+        ))
+
+    @track_stage("get_answer")
+    async def get_answer(self, user_id: int, prompt: str):
+        thread_id = response = None
+        try:
+            thread_id = await self._prepare_thread(user_id, prompt)
+
+            async with self.scheduler.limit("assistant"):
+                response = await self.api.call(
+                    "threads",
+                    self.client.beta.threads.runs.with_raw_response.create,
+                    thread_id=thread_id,
+                    assistant_id=self.assistant_id,
+                    instructions=RUN_INSTRUCTIONS,
+                    tools=RUN_TOOLS,
+                    tool_choice="auto",
+                    truncation_strategy=self.truncation_strategy,
+                    idempotent=False,
                 )
-                logger.info(f"Tool outputs submitted for run {response.id}")
-                response = await self.client.beta.threads.runs.retrieve(
-                    thread_id=self.user_threads[user_id],
-                    run_id=response.id
+                response = await self._wait_for_run(thread_id, response)
+            logger.info(f"Run started for user {user_id}: {response.id}")
+
+            while response.status == "requires_action":
+                tool_outputs = await self._handle_tool_calls(
+                    user_id, response.required_action.submit_tool_outputs.tool_calls
                 )
 
+                async with self.scheduler.limit("assistant"):
+                    response = await self.api.call(
+                        "threads",
+                        self.client.beta.threads.runs.with_raw_response.submit_tool_outputs,
+                        thread_id=thread_id,
+                        run_id=response.id,
+                        tool_outputs=tool_outputs,
+                        idempotent=False,
+                    )
+                    response = await self._wait_for_run(thread_id, response)
+                logger.info(f"Tool outputs submitted for run {response.id}, status: {response.status}")
+
             if response.status == "completed":
-                messages = await self.client.beta.threads.messages.list(
-                    thread_id=self.user_threads[user_id],
+                messages = await self.api.call(
+                    "threads",
+                    self.client.beta.threads.messages.with_raw_response.list,
+                    thread_id=thread_id,
+                    run_id=response.id,
+                    order="desc",
+                    limit=1,
+                    hedge=True,
                 )
                 for message in messages.data:
                     if message.role == "assistant":
                         if hasattr(message.content[0], 'text') and hasattr(message.content[0].text, 'annotations'):
                             annotations = message.content[0].text.annotations
                             for annotation in annotations:
-                                if hasattr(annotation, 'file_path'):
-                                    file_citation = getattr(annotation, 'file_citation', None)
-                                    if file_citation:
-                                        file_id = file_citation.file_id
-                                        file_info = await self.client.files.retrieve(file_id)
-                                        message.content[0].text.value = message.content[0].text.value.replace(
-                                            annotation.text, f"[из файла: {file_info.filename}]"
-                                        )
+                                if annotation.type == "file_citation":
+                                    file_name = await self._file_name(annotation.file_citation.file_id)
+                                    message.content[0].text.value = message.content[0].text.value.replace(
+                                        annotation.text, f"[из файла: {file_name}]"
+                                    )
 
                         assistant_message = message.content[0].text.value
                         logger.info(f"Received answer for user {user_id}: {assistant_message}")
+                        await self._finish_turn(user_id, thread_id)
                         return assistant_message
                 logger.warning("No assistant message found in the thread.")
-                return "Sorry, I couldn't generate a response."
+                return NO_RESPONSE
 
             elif response.status in ["failed", "cancelled"]:
                 logger.warning(f"Run failed or was cancelled: {response.status}")
-                return "Sorry, I couldn't process your request."
+                return REQUEST_FAILED
 
             else:
                 logger.warning(f"Unexpected run status: {response.status}")
-                return "Sorry, something went wrong."
+                return UNEXPECTED_STATUS
 
         except Exception as e:
             logger.error(f"Error in get_answer: {e}", exc_info=True)
-            return "An error occurred while processing your request."
+            return PROCESSING_ERROR
+        finally:
+            if response is not None and response.status not in TERMINAL_RUN_STATUSES:
+                await self._cancel_run(thread_id, response.id)
+
+    async def stream_answer(self, user_id: int, prompt: str):
+        splitter = SentenceSplitter()
+        yielded = False
+        thread_id = run = None
+        try:
+            thread_id = await self._prepare_thread(user_id, prompt)
+
+            async with self.scheduler.limit("assistant"):
+                stream = await self.api.call(
+                    "threads",
+                    self.client.beta.threads.runs.with_raw_response.create,
+                    thread_id=thread_id,
+                    assistant_id=self.assistant_id,
+                    instructions=RUN_INSTRUCTIONS,
+                    tools=RUN_TOOLS,
+                    tool_choice="auto",
+                    truncation_strategy=self.truncation_strategy,
+                    stream=True,
+                    idempotent=False,
+                )
+                while stream is not None:
+                    next_stream = None
+                    async for event in stream:
+                        if event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step."):
+                            run = event.data
+
+                        if event.event == "thread.message.delta":
+                            for part in event.data.delta.content or []:
+                                if part.type == "text" and part.text and part.text.value:
+                                    for annotation in part.text.annotations or []:
+                                        if annotation.type == "file_citation" and annotation.text and annotation.file_citation:
+                                            file_name = await self._file_name(annotation.file_citation.file_id)
+                                            splitter.citations[annotation.text] = f"[из файла: {file_name}]"
+                                    for sentence in splitter.feed(part.text.value):
+                                        yielded = True
+                                        yield sentence
+
+                        elif event.event == "thread.run.requires_action":
+                            tool_outputs = await self._handle_tool_calls(
+                                user_id, event.data.required_action.submit_tool_outputs.tool_calls
+                            )
+                            next_stream = await self.api.call(
+                                "threads",
+                                self.client.beta.threads.runs.with_raw_response.submit_tool_outputs,
+                                thread_id=thread_id,
+                                run_id=event.data.id,
+                                tool_outputs=tool_outputs,
+                                stream=True,
+                                idempotent=False,
+                            )
+                            logger.info(f"Tool outputs submitted for run {event.data.id}")
+
+                        elif event.event in ["thread.run.failed", "thread.run.cancelled", "thread.run.expired"]:
+                            logger.warning(f"Streamed run ended with {event.event} for user {user_id}")
+                    stream = next_stream
+
+            for sentence in splitter.flush():
+                yielded = True
+                yield sentence
+
+            if yielded:
+                await self._finish_turn(user_id, thread_id)
+
+            if not yielded:
+                logger.warning("Streamed run produced no assistant text.")
+                yield REQUEST_FAILED
 
-    async def text_to_voice(self, answer: str):
+        except Exception as e:
+            logger.error(f"Error in stream_answer: {e}", exc_info=True)
+            if not yielded:
+                yield PROCESSING_ERROR
+        finally:
+            if run is not None and run.status not in TERMINAL_RUN_STATUSES:
+                await self._cancel_run(thread_id, run.id)
+
+    def _audio_key(self, text: str) -> str:
+        raw = "\0".join([self.tts_model, self.tts_voice, self.tts_format, text])
+        return f"{hashlib.sha256(raw.encode('utf-8')).hexdigest()}.{self.tts_format}"
+
+    @track_stage("text_to_voice")
+    async def text_to_voice(self, answer: str) -> bytes:
+        key = self._audio_key(answer)
+        if self.audio_cache is not None:
+            cached = await self.audio_cache.get(key)
+            if cached is not None:
+                logger.info("Serving synthesized audio from cache")
+                return cached
         try:
-            unique_id = uuid4().hex
-            output_file = f"response_{unique_id}.mp3"
-            response = await self.client.audio.speech.create(
-                model="tts-1",
-                voice="alloy",
+            response = await self.api.call(
+                "tts",
+                self.client.audio.speech.with_raw_response.create,
+                model=self.tts_model,
+                voice=self.tts_voice,
                 input=answer,
+                response_format=self.tts_format,
             )
-            async with aiofiles.open(output_file, "wb") as f:
-                await f.write(response.content)
-
             logger.info(f"Text to voice conversion successful")
-            return output_file
+            audio = response.content
         except Exception as e:
             logger.error(f"Error in text_to_voice: {e}")
             raise
+        if self.audio_cache is not None:
+            await self.audio_cache.set(key, audio)
+        return audio
+
+    async def prewarm_audio_cache(self, texts):
+        if self.audio_cache is None:
+            return
+        await self.audio_cache.load()
+        missing = [text for text in dict.fromkeys(texts) if self._audio_key(text) not in self.audio_cache]
+        if not missing:
+            return
+        results = await asyncio.gather(*(self.text_to_voice(text) for text in missing), return_exceptions=True)
+        failed = sum(isinstance(result, Exception) for result in results)
+        logger.info(f"Pre-warmed audio cache with {len(missing) - failed}/{len(missing)} canned responses")
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from redis.asyncio import Redis
+
+from src.utils.logger import SCHEDULER_ACTIVE, SCHEDULER_USER_QUEUE, SCHEDULER_WAIT, SCHEDULER_WAITING
+
+logger = logging.getLogger(__name__)
+
+
+class WaitStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, slot: str, waited: float):
+        SCHEDULER_WAIT.labels(slot).observe(waited)
+        self.count += 1
+        self.total += waited
+        self.max = max(self.max, waited)
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_wait": self.total / self.count if self.count else 0.0,
+            "max_wait": self.max,
+        }
+
+
+class Scheduler:
+    def __init__(self, limits: dict[str, int], redis: Redis | None = None, user_lock_timeout: float = 180.0):
+        self.limits = limits
+        self.semaphores = {name: asyncio.Semaphore(limit) for name, limit in limits.items()}
+        self.redis = redis
+        self.user_lock_timeout = user_lock_timeout
+        self.user_locks: dict[int, asyncio.Lock] = {}
+        self.user_depth: dict[int, int] = defaultdict(int)
+        self.endpoint_waiting: dict[str, int] = defaultdict(int)
+        self.endpoint_active: dict[str, int] = defaultdict(int)
+        self.wait_stats: dict[str, WaitStats] = defaultdict(WaitStats)
+
+    @asynccontextmanager
+    async def user_slot(self, user_id: int):
+        lock = self.user_locks.setdefault(user_id, asyncio.Lock())
+        self.user_depth[user_id] += 1
+        SCHEDULER_USER_QUEUE.inc()
+        started = time.monotonic()
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, which keeps a user's messages in order
+            async with lock:
+                async with self._distributed_user_lock(user_id):
+                    self.wait_stats["user"].record("user", time.monotonic() - started)
+                    yield
+        finally:
+            self.user_depth[user_id] -= 1
+            SCHEDULER_USER_QUEUE.dec()
+            if self.user_depth[user_id] == 0:
+                del self.user_depth[user_id]
+                self.user_locks.pop(user_id, None)
+
+    @asynccontextmanager
+    async def _distributed_user_lock(self, user_id: int):
+        if self.redis is None:
+            yield
+            return
+        lock = self.redis.lock(
+            f"user_run:{user_id}",
+            timeout=self.user_lock_timeout,
+            blocking_timeout=self.user_lock_timeout,
+        )
+        try:
+            acquired = await lock.acquire()
+        except Exception as e:
+            logger.warning(f"Could not take Redis lock for user {user_id}: {e}")
+            acquired = False
+        if not acquired:
+            logger.warning(f"Proceeding without Redis lock for user {user_id}")
+        try:
+            yield
+        finally:
+            if acquired:
+                try:
+                    await lock.release()
+                except Exception as e:
+                    logger.warning(f"Could not release Redis lock for user {user_id}: {e}")
+
+    @asynccontextmanager
+    async def limit(self, endpoint: str):
+        semaphore = self.semaphores.get(endpoint)
+        if semaphore is None:
+            yield
+            return
+        self.endpoint_waiting[endpoint] += 1
+        SCHEDULER_WAITING.labels(endpoint).inc()
+        started = time.monotonic()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.endpoint_waiting[endpoint] -= 1
+            SCHEDULER_WAITING.labels(endpoint).dec()
+        self.wait_stats[endpoint].record(endpoint, time.monotonic() - started)
+        self.endpoint_active[endpoint] += 1
+        SCHEDULER_ACTIVE.labels(endpoint).inc()
+        try:
+            yield
+        finally:
+            self.endpoint_active[endpoint] -= 1
+            SCHEDULER_ACTIVE.labels(endpoint).dec()
+            semaphore.release()
+
+    def snapshot(self) -> dict:
+        return {
+            "users_queued": len(self.user_depth),
+            "user_queue_depth": sum(self.user_depth.values()),
+            "max_user_queue_depth": max(self.user_depth.values(), default=0),
+            "endpoints": {
+                name: {
+                    "limit": limit,
+                    "active": self.endpoint_active[name],
+                    "waiting": self.endpoint_waiting[name],
+                }
+                for name, limit in self.limits.items()
+            },
+            "waits": {name: stats.as_dict() for name, stats in self.wait_stats.items()},
+        }
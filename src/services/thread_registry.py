@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+from redis.asyncio import Redis
+
+from src.services.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadRegistry:
+    def __init__(self, redis: Redis | None, max_size: int = 10000, idle_ttl: int = 7 * 24 * 3600,
+                 local_ttl: float = 600.0, compaction_ttl: float = 180.0, poll_interval: float = 0.2):
+        self.redis = redis
+        self.idle_ttl = idle_ttl
+        self.compaction_ttl = compaction_ttl
+        self.poll_interval = poll_interval
+        # Only used without Redis or when it fails, since another process may rotate the thread at any time
+        self.local = LRUCache(max_size=max_size, ttl=min(local_ttl, idle_ttl))
+        self.local_turns = LRUCache(max_size=max_size, ttl=idle_ttl)
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"thread:{user_id}"
+
+    @staticmethod
+    def _turns_key(user_id: int) -> str:
+        return f"thread_turns:{user_id}"
+
+    @staticmethod
+    def _compacting_key(user_id: int) -> str:
+        return f"thread_compacting:{user_id}"
+
+    async def get(self, user_id: int) -> str | None:
+        if self.redis is None:
+            return self.local.get(self._key(user_id))
+        try:
+            raw = await self.redis.getex(self._key(user_id), ex=self.idle_ttl)
+        except Exception as e:
+            logger.warning(f"Could not read thread for user {user_id}: {e}")
+            return self.local.get(self._key(user_id))
+        if raw is None:
+            self.local.delete(self._key(user_id))
+            return None
+        thread_id = raw.decode() if isinstance(raw, bytes) else raw
+        self.local.set(self._key(user_id), thread_id)
+        return thread_id
+
+    async def set(self, user_id: int, thread_id: str):
+        self.local.set(self._key(user_id), thread_id)
+        self.local_turns.delete(self._turns_key(user_id))
+        if self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.set(self._key(user_id), thread_id, ex=self.idle_ttl)
+                    pipe.delete(self._turns_key(user_id))
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning(f"Could not store thread for user {user_id}: {e}")
+
+    async def delete(self, user_id: int):
+        self.local.delete(self._key(user_id))
+        if self.redis is not None:
+            try:
+                await self.redis.delete(self._key(user_id))
+            except Exception as e:
+                logger.warning(f"Could not delete thread for user {user_id}: {e}")
+
+    async def increment_turns(self, user_id: int) -> int:
+        if self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.incr(self._turns_key(user_id))
+                    pipe.expire(self._turns_key(user_id), self.idle_ttl)
+                    turns, _ = await pipe.execute()
+                return int(turns)
+            except Exception as e:
+                logger.warning(f"Could not count turns for user {user_id}: {e}")
+        turns = (self.local_turns.get(self._turns_key(user_id)) or 0) + 1
+        self.local_turns.set(self._turns_key(user_id), turns)
+        return turns
+
+    async def start_compaction(self, user_id: int) -> bool:
+        # Marks the thread as being rotated, so every process holds the user's next message until it's done
+        if self.redis is None:
+            return True
+        try:
+            return bool(await self.redis.set(self._compacting_key(user_id), 1, nx=True, ex=int(self.compaction_ttl)))
+        except Exception as e:
+            logger.warning(f"Could not mark compaction for user {user_id}: {e}")
+            return False
+
+    async def finish_compaction(self, user_id: int):
+        if self.redis is not None:
+            try:
+                await self.redis.delete(self._compacting_key(user_id))
+            except Exception as e:
+                logger.warning(f"Could not clear compaction mark for user {user_id}: {e}")
+
+    async def wait_for_compaction(self, user_id: int):
+        if self.redis is None:
+            return
+        deadline = time.monotonic() + self.compaction_ttl
+        while time.monotonic() < deadline:
+            try:
+                if not await self.redis.exists(self._compacting_key(user_id)):
+                    return
+            except Exception as e:
+                logger.warning(f"Could not check compaction of user {user_id}: {e}")
+                return
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,33 @@
+import argparse
+import asyncio
+import logging
+
+from src.config import get_settings
+from src.services.openai_service import OpenAIBot
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Sync a directory of documents into the assistant vector store")
+    parser.add_argument("directory")
+    parser.add_argument("--manifest", default="vector_store_manifest.json")
+    parser.add_argument("--name", default="Values Documents")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    settings = get_settings()
+    openai_service = OpenAIBot(api_key=settings.OPENAI_API_KEY, assistant_id=settings.OPENAI_ASSISTANT_ID)
+    await openai_service.sync_vector_store(
+        args.directory,
+        manifest_path=args.manifest,
+        name=args.name,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+    )
+    await openai_service.update_assistant_with_file_search()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
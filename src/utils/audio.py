@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import re
+import shutil
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+SILENCE_START = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+SILENCE_END = re.compile(r"silence_end: (-?\d+(?:\.\d+)?)")
+PROGRESS_TIME = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+@lru_cache(maxsize=1)
+def ffmpeg_available() -> bool:
+    if shutil.which("ffmpeg") is None:
+        logger.warning("ffmpeg not found, voice messages are sent to STT unprocessed")
+        return False
+    return True
+
+
+async def run_ffmpeg(args: list[str], content: bytes) -> tuple[bytes, str]:
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-nostdin", *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate(content)
+    log = stderr.decode("utf-8", errors="replace")
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {log[-500:]}")
+    return stdout, log
+
+
+def parse_silences(log: str) -> list[tuple[float, float]]:
+    silences = []
+    start = None
+    for line in log.splitlines():
+        if match := SILENCE_START.search(line):
+            start = max(float(match.group(1)), 0.0)
+        elif (match := SILENCE_END.search(line)) and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    return silences
+
+
+def parse_duration(log: str) -> float | None:
+    matches = PROGRESS_TIME.findall(log.replace("\r", "\n"))
+    if not matches:
+        return None
+    hours, minutes, seconds = matches[-1]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def plan_chunks(duration: float, silences: list[tuple[float, float]], max_chunk: float,
+                min_chunk: float) -> list[tuple[float, float]]:
+    # Cut in the middle of the latest pause that keeps the chunk under max_chunk,
+    # and only fall back to a hard cut when there is no pause at all.
+    pauses = sorted((start + end) / 2 for start, end in silences)
+    chunks = []
+    cursor = 0.0
+    while duration - cursor > max_chunk:
+        candidates = [p for p in pauses if cursor + min_chunk <= p <= cursor + max_chunk]
+        cut = candidates[-1] if candidates else cursor + max_chunk
+        chunks.append((cursor, cut))
+        cursor = cut
+    chunks.append((cursor, duration))
+    return chunks
+
+
+async def preprocess_voice(content: bytes, sample_rate: int = 16000, bitrate: str = "24k",
+                           silence_threshold: str = "-40dB", min_silence: float = 0.4) -> tuple[bytes, float | None, list]:
+    trim = (
+        f"silenceremove=start_periods=1:start_threshold={silence_threshold}:start_silence=0.1"
+    )
+    filters = ",".join([
+        # Trimming the tail is done by trimming the start of the reversed stream
+        trim, "areverse", trim, "areverse",
+        f"silencedetect=noise={silence_threshold}:d={min_silence}",
+    ])
+    encoded, log = await run_ffmpeg([
+        "-i", "pipe:0",
+        "-af", filters,
+        "-ac", "1",
+        "-ar", str(sample_rate),
+        "-c:a", "libopus",
+        "-b:a", bitrate,
+        "-application", "voip",
+        "-f", "ogg",
+        "pipe:1",
+    ], content)
+    return encoded, parse_duration(log), parse_silences(log)
+
+
+async def cut_chunk(content: bytes, start: float, end: float) -> bytes:
+    chunk, _ = await run_ffmpeg([
+        "-i", "pipe:0",
+        "-ss", f"{start:.3f}",
+        "-to", f"{end:.3f}",
+        "-c", "copy",
+        "-f", "ogg",
+        "pipe:1",
+    ], content)
+    return chunk
+
+
+async def split_voice(content: bytes, max_chunk: float = 60.0, sample_rate: int = 16000, bitrate: str = "24k",
+                      silence_threshold: str = "-40dB", min_silence: float = 0.4) -> list[bytes]:
+    if not ffmpeg_available():
+        return [content]
+    try:
+        encoded, duration, silences = await preprocess_voice(
+            content, sample_rate, bitrate, silence_threshold, min_silence
+        )
+        if not encoded:
+            return [content]
+        logger.info(f"Voice re-encoded from {len(content)} to {len(encoded)} bytes ({duration or 0:.1f}s)")
+        if duration is None or duration <= max_chunk:
+            return [encoded]
+        chunks = plan_chunks(duration, silences, max_chunk, min_chunk=max_chunk / 2)
+        logger.info(f"Splitting {duration:.1f}s voice into {len(chunks)} chunks")
+        return list(await asyncio.gather(*(cut_chunk(encoded, start, end) for start, end in chunks)))
+    except Exception as e:
+        logger.warning(f"Voice preprocessing failed, sending original audio: {e}")
+        return [content]
@@ -0,0 +1,36 @@
+from io import BytesIO
+
+from PIL import Image
+
+MOOD_UNDETECTED = "Не удалось определить настроение."
+
+
+def dhash(content: bytes, size: int = 8) -> str:
+    with Image.open(BytesIO(content)) as image:
+        small = image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | int(left > right)
+    return f"{bits:0{size * size // 4}x}"
+
+
+def pick_photo_size(sizes: list, target_side: int):
+    for size in sorted(sizes, key=lambda s: s.width * s.height):
+        if max(size.width, size.height) >= target_side:
+            return size
+    return max(sizes, key=lambda s: s.width * s.height)
+
+
+def downscale_jpeg(content: bytes, max_side: int, quality: int = 85) -> bytes:
+    with Image.open(BytesIO(content)) as image:
+        if max(image.size) <= max_side and image.format == "JPEG":
+            return content
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
@@ -0,0 +1,74 @@
+import logging
+import time
+from functools import wraps
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+
+STAGE_LATENCY = Histogram(
+    "bot_stage_latency_seconds", "Latency of pipeline stages", ["stage"], buckets=LATENCY_BUCKETS
+)
+STAGE_ERRORS = Counter("bot_stage_errors_total", "Pipeline stage failures", ["stage"])
+OPENAI_REQUESTS = Counter("bot_openai_requests_total", "OpenAI API requests", ["endpoint", "status"])
+OPENAI_TOKENS = Counter("bot_openai_tokens_total", "OpenAI tokens used", ["endpoint", "kind"])
+CACHE_REQUESTS = Counter("bot_cache_requests_total", "Cache lookups", ["cache", "result"])
+SCHEDULER_USER_QUEUE = Gauge("bot_scheduler_user_queue_depth", "Requests waiting for or holding a user slot")
+SCHEDULER_ACTIVE = Gauge("bot_scheduler_active", "Requests holding an endpoint slot", ["endpoint"])
+SCHEDULER_WAITING = Gauge("bot_scheduler_waiting", "Requests waiting for an endpoint slot", ["endpoint"])
+SCHEDULER_WAIT = Histogram(
+    "bot_scheduler_wait_seconds", "Time spent waiting for a scheduler slot", ["slot"], buckets=LATENCY_BUCKETS
+)
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Time from process start until the app was ready")
+JOBS = Counter("bot_jobs_total", "Queued media jobs", ["kind", "result"])
+JOB_QUEUE_WAIT = Histogram(
+    "bot_job_queue_wait_seconds", "Time from enqueue to the start of processing", ["kind"], buckets=LATENCY_BUCKETS
+)
+
+
+def setup_logging(level: int = logging.INFO):
+    logging.basicConfig(level=level)
+
+
+class track_stage:
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_LATENCY.labels(self.stage).observe(time.perf_counter() - self.started)
+        if exc_type is not None:
+            STAGE_ERRORS.labels(self.stage).inc()
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+    def __call__(self, func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with track_stage(self.stage):
+                return await func(*args, **kwargs)
+        return wrapper
+
+
+def record_usage(endpoint: str, response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if value:
+            OPENAI_TOKENS.labels(endpoint, kind).inc(value)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
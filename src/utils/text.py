@@ -0,0 +1,62 @@
+import re
+from functools import lru_cache
+
+try:
+    import pymorphy3
+except ImportError:
+    pymorphy3 = None
+
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+CITATION_MARKER = re.compile(r"【[^】]*】")
+WORD = re.compile(r"\w+")
+
+
+def strip_citation_markers(text: str, citations: dict[str, str] | None = None) -> str:
+    # Known markers become their replacement, any other marker is dropped
+    return CITATION_MARKER.sub(lambda match: (citations or {}).get(match.group(0), ""), text)
+
+
+@lru_cache(maxsize=1)
+def _morph_analyzer():
+    return pymorphy3.MorphAnalyzer() if pymorphy3 is not None else None
+
+
+@lru_cache(maxsize=8192)
+def _lemma(word: str) -> str:
+    morph = _morph_analyzer()
+    if morph is None:
+        return word
+    return morph.parse(word)[0].normal_form
+
+
+def normalize_value(text: str) -> str:
+    words = WORD.findall(text.lower().replace("ё", "е"))
+    return " ".join(_lemma(word) for word in words)
+
+
+class SentenceSplitter:
+    def __init__(self, min_length: int = 40):
+        self.min_length = min_length
+        self.buffer = ""
+        # Citation marker -> text that replaces it, filled from the stream's annotations
+        self.citations: dict[str, str] = {}
+
+    def feed(self, text: str) -> list[str]:
+        self.buffer += text
+        segments = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            # Short sentences are glued to the next one so we don't send a voice note per "Да."
+            if match.start() - start >= self.min_length:
+                segments.append(self._clean(self.buffer[start:match.start()]))
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return [segment for segment in segments if segment]
+
+    def flush(self) -> list[str]:
+        rest = self._clean(self.buffer)
+        self.buffer = ""
+        return [rest] if rest else []
+
+    def _clean(self, text: str) -> str:
+        return strip_citation_markers(text, self.citations).strip()
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+from multiprocessing.connection import wait
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+RESTART_MIN_UPTIME = 60.0
+
+
+async def run_worker():
+    from src.app import create_app
+    from src.bot import job_handlers, on_job_failed
+    from src.services.job_queue import JobWorker
+
+    app = create_app()
+    settings = app.settings
+    if app.job_queue is None:
+        raise RuntimeError("Job queue is disabled, set JOB_QUEUE_ENABLED and REDIS_HOST")
+
+    worker = JobWorker(
+        app.job_queue,
+        job_handlers(app),
+        on_dead=partial(on_job_failed, app),
+        concurrency=settings.JOB_WORKER_CONCURRENCY,
+        max_shards=settings.JOB_MAX_SHARDS_PER_WORKER or None,
+        retry_delay=settings.JOB_RETRY_DELAY,
+    )
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+
+    await app.start()
+    try:
+        await worker.run()
+    finally:
+        await app.stop()
+        await app.bot.session.close()
+
+
+def worker_process():
+    from src.utils.logger import setup_logging
+    setup_logging()
+    asyncio.run(run_worker())
+
+
+def main():
+    from src.config import get_settings
+    settings = get_settings()
+
+    # Spawned processes import the bot module from scratch instead of inheriting open connections
+    context = multiprocessing.get_context("spawn")
+    stopping = False
+
+    def spawn(index: int):
+        process = context.Process(target=worker_process, name=f"job-worker-{index}")
+        process.start()
+        return process, time.monotonic()
+
+    workers = {index: spawn(index) for index in range(settings.JOB_WORKERS)}
+    logger.info(f"Started {len(workers)} job workers")
+
+    def forward(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process, _ in workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    while workers:
+        wait([process.sentinel for process, _ in workers.values()])
+        for index, (process, started) in list(workers.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del workers[index]
+            if stopping:
+                continue
+            if time.monotonic() - started < RESTART_MIN_UPTIME:
+                # Crashing right after start won't fix itself, let the orchestrator restart the whole service
+                logger.error(f"{process.name} exited with code {process.exitcode} right after starting")
+                forward(signal.SIGTERM, None)
+                for other, _ in workers.values():
+                    other.join()
+                sys.exit(1)
+            logger.error(f"{process.name} exited with code {process.exitcode}, restarting it")
+            workers[index] = spawn(index)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()